@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of JDF_NLIST on synthetic beams.
+
+Writes synthetic bunches (Gaussian or flat-top, with chirped momentum) in the
+/Particles layout (x, px, y, py, z, pz, NE - momenta in p/mc), upsamples them
+with JDF_NLIST and reports the wall time of every stage of the pipeline and
+the fidelity of the new particle set (charge, current profile, emittance and
+momentum moments compared with the input).
+"""
+
+import numpy as np
+import sys
+import os
+import argparse
+import json
+import tempfile
+import time
+
+import JDF_NLIST
+
+# Benchmark cases - (number of input particles, number of slices)
+BENCHMARK_SIZES = [(10**4, 100), (10**5, 1000), (10**6, 1000), (10**7, 10**4)]
+
+# Stages of the pipeline in the order they are reported
+BENCHMARK_STAGES = [
+    "histogramming",
+    "interpolator build",
+    "momentum input",
+    "triangulation",
+    "slice loop",
+    "assembly",
+    "momentum mapping",
+    "writing",
+]
+
+
+# Write a synthetic beam of n particles to /Particles of file_name.
+# shape - "gaussian" or "flattop" longitudinal profile (rms length sigma_z for
+# gaussian, full length 2*sqrt(3)*sigma_z for flattop, same rms), transverse
+# Gaussian with sigma_xy and normalized emittance emittance (m rad),
+# pz = gamma*(1 + chirp*z/sigma_z) + uncorrelated energy_spread*gamma,
+# charge in C is shared equally by all particles.
+def SyntheticBeam(
+    file_name,
+    n,
+    shape="gaussian",
+    sigma_xy=50e-6,
+    sigma_z=20e-6,
+    gamma=1000.0,
+    chirp=0.01,
+    energy_spread=0.001,
+    emittance=1e-6,
+    charge=1e-9,
+    seed=0,
+    chunk_rows=1000000,
+):
+    import tables
+
+    rng = np.random.RandomState(seed)
+    sigma_p = emittance / sigma_xy
+    weight = charge / JDF_NLIST.e_ch / n
+    f = tables.open_file(file_name, "w")
+    Particles = f.create_earray(
+        f.root,
+        "Particles",
+        tables.Float64Atom(),
+        (0, 7),
+        expectedrows=n,
+    )
+    for first in range(0, n, chunk_rows):
+        rows = min(chunk_rows, n - first)
+        block = np.empty((rows, 7))
+        block[:, 0] = rng.normal(0.0, sigma_xy, rows)
+        block[:, 1] = rng.normal(0.0, sigma_p, rows)
+        block[:, 2] = rng.normal(0.0, sigma_xy, rows)
+        block[:, 3] = rng.normal(0.0, sigma_p, rows)
+        if shape == "gaussian":
+            block[:, 4] = rng.normal(0.0, sigma_z, rows)
+        elif shape == "flattop":
+            block[:, 4] = rng.uniform(-np.sqrt(3.0), np.sqrt(3.0), rows) * sigma_z
+        else:
+            raise ValueError("Unknown beam shape: " + str(shape))
+        block[:, 5] = gamma * (
+            1.0 + chirp * block[:, 4] / sigma_z + rng.normal(0.0, energy_spread, rows)
+        )
+        block[:, 6] = weight
+        Particles.append(block)
+    f.close()
+
+
+# Weighted moments of the particles of file_name, read in chunks: charge (C),
+# means and rms of all six coordinates, normalized emittances in x and y and
+# the current profile (charge per bin over the z bin edges edges_z, default:
+# 100 bins over the range of the particles). Any format of JDF_NLIST.ParticleFile.
+def BeamMoments(file_name, edges_z=None, chunk_rows=1000000):
+    f = JDF_NLIST.ParticleFile(file_name)
+    Particles = f.Particles
+    if edges_z is None:
+        stats = JDF_NLIST.ScanParticles(Particles, chunk_rows)
+        edges_z = np.linspace(stats["min"][4], stats["max"][4], 101)
+    weight = 0.0
+    sums = np.zeros(6)
+    products = np.zeros((6, 6))
+    profile = np.zeros(len(edges_z) - 1)
+    for first, chunk in JDF_NLIST.IterParticleChunks(Particles, chunk_rows):
+        w = chunk[:, 6]
+        weight += np.sum(w)
+        sums += np.dot(w, chunk[:, :6])
+        products += np.dot((chunk[:, :6] * w[:, None]).T, chunk[:, :6])
+        profile += np.histogram(chunk[:, 4], bins=edges_z, weights=w)[0]
+    f.close()
+    mean = sums / weight
+    covariance = products / weight - np.outer(mean, mean)
+    rms = np.sqrt(np.maximum(np.diag(covariance), 0.0))
+
+    def Emittance(i, j):
+        det = covariance[i, i] * covariance[j, j] - covariance[i, j] ** 2
+        return np.sqrt(max(det, 0.0))
+
+    return {
+        "charge": weight * JDF_NLIST.e_ch,
+        "mean": mean,
+        "rms": rms,
+        "emittance_x": Emittance(0, 1),
+        "emittance_y": Emittance(2, 3),
+        "edges_z": edges_z,
+        "current_profile": profile * JDF_NLIST.e_ch,
+    }
+
+
+# Fidelity of the output file_out with respect to the input file_in - relative
+# differences of charge, emittances, rms sizes and mean pz, differences of the
+# mean transverse momenta and the largest difference of the normalized current
+# profiles (relative to the profile peak)
+def BeamFidelity(file_in, file_out, chunk_rows=1000000):
+    inp = BeamMoments(file_in, chunk_rows=chunk_rows)
+    out = BeamMoments(file_out, inp["edges_z"], chunk_rows)
+    labels = ["x", "px", "y", "py", "z", "pz"]
+    fidelity = {
+        "charge": out["charge"] / inp["charge"] - 1.0,
+        "emittance_x": out["emittance_x"] / inp["emittance_x"] - 1.0,
+        "emittance_y": out["emittance_y"] / inp["emittance_y"] - 1.0,
+        "mean_pz": out["mean"][5] / inp["mean"][5] - 1.0,
+        "mean_px": out["mean"][1] - inp["mean"][1],
+        "mean_py": out["mean"][3] - inp["mean"][3],
+    }
+    for i, label in enumerate(labels):
+        fidelity["rms_" + label] = out["rms"][i] / inp["rms"][i] - 1.0
+    profile_in = inp["current_profile"] / np.sum(inp["current_profile"])
+    profile_out = out["current_profile"] / np.sum(out["current_profile"])
+    fidelity["current_profile"] = np.max(np.abs(profile_out - profile_in)) / np.max(
+        profile_in
+    )
+    return fidelity
+
+
+# Run one benchmark case - n input particles upsampled into about slices slices
+# (SlicesMultiplyFactor is chosen accordingly), further JDF parameters in
+# params. Files are written to directory. Returns a dict with the wall times of
+# the stages, the total time and the fidelity of the result.
+def BenchmarkCase(n, slices, directory, shape="gaussian", params=None, seed=0):
+    file_in = os.path.join(directory, "beam_%d_%s.h5" % (n, shape))
+    if not os.path.exists(file_in):
+        SyntheticBeam(file_in, n, shape=shape, seed=seed)
+    P = JDF_NLIST.ReadParameters(params, params_module=None)
+    import tables
+
+    f = tables.open_file(file_in, "r")
+    stats = JDF_NLIST.ScanParticles(f.root.Particles, P["InputChunkSize"])
+    f.close()
+    lambda_u = (2.0 * np.pi) / P["k_u"]
+    lambda_r = (lambda_u / (2.0 * stats["gamma_0"] ** 2.0)) * (
+        1 + (P["a_u"] ** 2.0) / 2.0
+    )
+    size_z = stats["max"][4] - stats["min"][4]
+    S_factor = P["BeamStretchFactor"]
+    # int() in the slice count, slightly more to get slices and not slices - 1
+    SlicesMultiplyFactor = (slices + 0.5) * lambda_r / (size_z * (1 + 2 * S_factor))
+    params = dict(params or {})
+    params.setdefault("RNG_seed", seed)
+    params["SlicesMultiplyFactor"] = SlicesMultiplyFactor
+    file_out = os.path.join(directory, "beam_%d_%s_%d.h5" % (n, shape, slices))
+    start = time.time()
+    result = JDF_NLIST.run_jdf(
+        file_in, params=params, params_module=None, out_file=file_out
+    )
+    total = time.time() - start
+    return {
+        "particles_in": n,
+        "slices": result["NumberOfSlices"],
+        "particles_out": result["Total_Number_Of_Particles"],
+        "shape": shape,
+        "stage_times": result["stage_times"],
+        "total_time": total,
+        "fidelity": BeamFidelity(file_in, file_out, P["InputChunkSize"] or 1000000),
+    }
+
+
+# Print the results of the benchmark cases as two tables (times and fidelity)
+def PrintBenchmark(results, stream=sys.stdout):
+    header = "%10s %7s %10s" % ("particles", "slices", "new")
+    stream.write(
+        header
+        + "".join(" %12s" % name[:12] for name in BENCHMARK_STAGES)
+        + " %12s\n" % "total [s]"
+    )
+    for r in results:
+        stream.write(
+            "%10d %7d %10d" % (r["particles_in"], r["slices"], r["particles_out"])
+        )
+        for name in BENCHMARK_STAGES:
+            stream.write(" %12.3f" % r["stage_times"].get(name, 0.0))
+        stream.write(" %12.3f\n" % r["total_time"])
+    names = sorted(results[0]["fidelity"]) if results else []
+    stream.write("\n" + header + "".join(" %12s" % name[:12] for name in names))
+    stream.write("\n")
+    for r in results:
+        stream.write(
+            "%10d %7d %10d" % (r["particles_in"], r["slices"], r["particles_out"])
+        )
+        for name in names:
+            stream.write(" %12.2e" % r["fidelity"][name])
+        stream.write("\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="JDF_BENCHMARK",
+        description="Benchmark JDF_NLIST on synthetic beams.",
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        metavar="PARTICLES:SLICES",
+        help="benchmark cases (default: "
+        + " ".join("%d:%d" % size for size in BENCHMARK_SIZES)
+        + ")",
+    )
+    parser.add_argument("--shape", default="gaussian", choices=["gaussian", "flattop"])
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="JDF parameter, e.g. NumOfSliceParticles=800",
+    )
+    parser.add_argument(
+        "--dir", help="directory for the beam files (default: temporary)"
+    )
+    parser.add_argument("--json", metavar="FILE", help="write the results to FILE")
+    args = parser.parse_args(argv)
+
+    import ast
+
+    sizes = BENCHMARK_SIZES
+    if args.sizes:
+        sizes = []
+        for item in args.sizes:
+            n, sep, slices = item.partition(":")
+            if not sep:
+                parser.error("--sizes expects PARTICLES:SLICES, got " + item)
+            sizes.append((int(float(n)), int(float(slices))))
+    params = {}
+    for item in args.set:
+        name, sep, value = item.partition("=")
+        if not sep or name.strip() not in JDF_NLIST.JDF_PARAMETERS:
+            parser.error("--set expects NAME=VALUE with a JDF parameter NAME")
+        try:
+            params[name.strip()] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            params[name.strip()] = value
+
+    directory = args.dir or tempfile.mkdtemp(prefix="jdf_benchmark_")
+    os.makedirs(directory, exist_ok=True)
+    results = []
+    for n, slices in sizes:
+        results.append(BenchmarkCase(n, slices, directory, args.shape, params))
+    PrintBenchmark(results)
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(results, out, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,4 @@
-#! /usr/bin/env python2
+#! /usr/bin/env python3
 
 # -*- coding: utf-8 -*-
 """
@@ -6,34 +6,33 @@ Created on Fri Sep 14 11:07:07 2018
 
 @author: Piotr Traczykowski
 """
-import tables
+
 import numpy as np
-import matplotlib.pyplot as plt
-import scipy.ndimage as ndimage
-from math import log, floor, ceil, fmod
-from scipy import interpolate
+from math import log, floor, ceil, fmod, fsum
 import sys
+import os
+import argparse
 import datetime
+import importlib.util
 import multiprocessing
 import time
 
-### The below line os.nice(15) is to reduce the process priority on your system
-### This is to allow your system to behave more smoothly while still the
-### JDF will utilize all of its resources
-import os
-
-os.nice(20)
+# scipy, tables and matplotlib are imported where they are used, so that the
+# module starts quickly (batch jobs, worker processes, use as a library)
 
 
 ##################################################################
 ##################################################################
 ##################################################################
 
+
 # Core procedure for JDF routine
 def JDF_CORE(f_Z, X_inp, Y_inp, dist_in, smoothing, rand_x, rand_y, DDDz, NoOfElec):
+    from scipy import interpolate
+
     init_column_dist = np.sum(dist_in, 0)
-    Xh = np.linspace(np.min(X_inp), np.max(X_inp), np.rint(smoothing * len(X_inp)))
-    Yh = np.linspace(np.min(Y_inp), np.max(Y_inp), np.rint(smoothing * len(Y_inp)))
+    Xh = np.linspace(np.min(X_inp), np.max(X_inp), int(np.rint(smoothing * len(X_inp))))
+    Yh = np.linspace(np.min(Y_inp), np.max(Y_inp), int(np.rint(smoothing * len(Y_inp))))
     f_col_dist = interpolate.interp1d(X_inp, init_column_dist)
     intp_col_dist = f_col_dist(Xh)
 
@@ -73,6 +72,8 @@ def JDF_CORE(f_Z, X_inp, Y_inp, dist_in, smoothing, rand_x, rand_y, DDDz, NoOfEl
 
 # Generate particle X coordinate
 def GenerateParticleX(PDF_x, ranDx, Xhin):
+    from scipy import interpolate
+
     Px_CDF = np.cumsum(PDF_x)
     Px_CDF = np.sort(Px_CDF)
     f_X = interpolate.interp1d(Px_CDF, Xhin, fill_value="extrapolate")
@@ -82,6 +83,8 @@ def GenerateParticleX(PDF_x, ranDx, Xhin):
 
 # Generate particle Y coordinate
 def GenerateParticleY(PDF_y, ranDy, Yhin):
+    from scipy import interpolate
+
     Py_CDF = np.cumsum(PDF_y)
     Py_CDF = np.sort(Py_CDF)
     f_Y = interpolate.interp1d(Py_CDF, Yhin, fill_value="extrapolate")
@@ -89,67 +92,337 @@ def GenerateParticleY(PDF_y, ranDy, Yhin):
     return y0
 
 
-# Generate Halton sequences
-def HaltonRandomNumber(dims, nb_pts):
-    hArr = np.empty(nb_pts * dims)
-    hArr.fill(np.nan)
-    pArr = np.empty(nb_pts)
-    pArr.fill(np.nan)
-    Primes = [
-        2,
-        3,
-        5,
-        7,
-        11,
-        13,
-        17,
-        19,
-        23,
-        29,
-        31,
-        37,
-        41,
-        43,
-        47,
-        53,
-        59,
-        61,
-        67,
-        71,
-        73,
-        79,
-        83,
-        89,
-        97,
-        101,
-        103,
-        107,
-        109,
-        113,
-        127,
-        131,
-        137,
-        139,
-        149,
-        151,
-        157,
-        163,
-    ]
-    log_nb_pts = log(nb_pts + 1)
-    for i in range(dims):
-        b = Primes[i]
-        n = np.int(np.ceil(log_nb_pts / np.log(b)))
-        for t in range(n):
-            pArr[t] = np.float_power(b, -(t + 1))
-
-        for j in range(nb_pts):
-            d = j + 1
-            sum_ = np.fmod(d, b) * pArr[0]
-            for t in range(1, n):
-                d = np.floor(d / b)
-                sum_ += np.fmod(d, b) * pArr[t]
-            hArr[j * dims + i] = sum_
-    return hArr.reshape(nb_pts, dims)
+# Linear interpolation with linear extrapolation outside of the data range,
+# evaluated with exactly the same arithmetic as interpolate.interp1d (kind='linear')
+# so that batched and per-particle sampling give identical numbers.
+# xp is either one sorted table shared by all points in x, or a 2D array with one
+# sorted row per point in x; fp holds the matching ordinates (len(fp) == xp.shape[-1]).
+def Interp1dLinear(xp, fp, x):
+    if xp.ndim == 1:
+        x_new_indices = np.searchsorted(xp, x)
+        x_new_indices = x_new_indices.clip(1, len(xp) - 1)
+        lo = x_new_indices - 1
+        hi = x_new_indices
+        x_lo = xp[lo]
+        x_hi = xp[hi]
+        y_lo = fp[lo]
+        y_hi = fp[hi]
+    else:
+        # Row-wise searchsorted(side='left') on sorted rows
+        x_new_indices = np.sum(xp < x[:, None], axis=1)
+        x_new_indices = x_new_indices.clip(1, xp.shape[1] - 1)
+        lo = x_new_indices - 1
+        hi = x_new_indices
+        rows = np.arange(len(x))
+        x_lo = xp[rows, lo]
+        x_hi = xp[rows, hi]
+        y_lo = fp[lo]
+        y_hi = fp[hi]
+    slope = (y_hi - y_lo) / (x_hi - x_lo)
+    return slope * (x - x_lo) + y_lo
+
+
+# np.interp applied to every row of fp at once (all rows share xp and x) - same
+# arithmetic as np.interp, which interp1d uses for in-range linear interpolation.
+def InterpRows(x, xp, fp):
+    j = np.searchsorted(xp, x, side="right") - 1
+    j = j.clip(0, len(xp) - 2)
+    x_lo = xp[j]
+    x_hi = xp[j + 1]
+    y_lo = fp[:, j]
+    y_hi = fp[:, j + 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (y_hi - y_lo) / (x_hi - x_lo)
+        result = slope * (x - x_lo) + y_lo
+        # Retry from the upper point where the lower one gives NaN (as np.interp does)
+        retry = np.isnan(result)
+        if np.any(retry):
+            result[retry] = (slope * (x - x_hi) + y_hi)[retry]
+            flat = retry & (y_lo == y_hi)
+            result[flat] = y_lo[flat]
+    # Points lying exactly on a node take the node value, outside of xp the end values
+    exact = x == x_lo
+    result[:, exact] = fp[:, j[exact]]
+    result[:, x < xp[0]] = fp[:, :1]
+    result[:, x >= xp[-1]] = fp[:, -1:]
+    # C order keeps the row sums bit-identical to summing each row on its own
+    return np.ascontiguousarray(result)
+
+
+# Vectorized version of JDF_CORE - the column distribution and its CDF are built
+# once for the slice and all particles (rand_x, rand_y arrays) are drawn at once.
+# Gives the same results as calling JDF_CORE for every pair of random numbers.
+def JDF_CORE_BATCH(X_inp, Y_inp, dist_in, smoothing, rand_x, rand_y, DDDz, NoOfElec):
+    from scipy import interpolate
+
+    rand_x = np.asarray(rand_x, dtype=float)
+    rand_y = np.asarray(rand_y, dtype=float)
+    init_column_dist = np.sum(dist_in, 0)
+    Xh = np.linspace(np.min(X_inp), np.max(X_inp), int(np.rint(smoothing * len(X_inp))))
+    Yh = np.linspace(np.min(Y_inp), np.max(Y_inp), int(np.rint(smoothing * len(Y_inp))))
+    f_col_dist = interpolate.interp1d(X_inp, init_column_dist)
+    intp_col_dist = f_col_dist(Xh)
+
+    #   Make sure interpolated values are positive
+    intp_col_dist = intp_col_dist.clip(min=0.0)
+    intp_col_dist = intp_col_dist / np.sum(intp_col_dist)
+    x0 = GenerateParticleXBatch(intp_col_dist, rand_x, Xh)
+
+    #   Find corresponding indices and weights in the other dimension
+    indx_temp = np.argsort(np.square(x0[:, None] - X_inp[None, :]), axis=1)
+    indx_temp = indx_temp[:, :2]
+
+    min_val = np.min(indx_temp, axis=1)
+    max_val = np.max(indx_temp, axis=1)
+
+    X_min = X_inp[min_val]
+    X_max = X_inp[max_val]
+
+    tw1 = 1.0 - (x0 - X_min) / (X_max - X_min)
+    tw2 = 1.0 - (X_max - x0) / (X_max - X_min)
+
+    # One row distribution per particle - shape (particles, len(Y_inp))
+    init_row_dist = (
+        tw1[:, None] * dist_in[:, min_val].T + tw2[:, None] * dist_in[:, max_val].T
+    )
+
+    #   All rows share the same abscissa, so interpolate them in one call
+    intp_row_dist = InterpRows(Yh, Y_inp, init_row_dist)
+
+    #   Make sure interpolated values are positive
+    intp_row_dist = intp_row_dist.clip(min=0.0)
+    intp_row_dist = intp_row_dist / np.sum(intp_row_dist, axis=1)[:, None]
+    y0 = GenerateParticleYBatch(intp_row_dist, rand_y, Yh)
+
+    DDDz = np.broadcast_to(DDDz, x0.shape)
+    NoOfElec = np.broadcast_to(NoOfElec, x0.shape)
+    return np.column_stack((x0, y0, DDDz, NoOfElec))
+
+
+# Generate X coordinates for all random numbers ranDx from one PDF
+def GenerateParticleXBatch(PDF_x, ranDx, Xhin):
+    Px_CDF = np.cumsum(PDF_x)
+    Px_CDF = np.sort(Px_CDF)
+    return Interp1dLinear(Px_CDF, Xhin, ranDx)
+
+
+# Generate Y coordinates - one PDF (row of PDF_y) per random number in ranDy
+def GenerateParticleYBatch(PDF_y, ranDy, Yhin):
+    Py_CDF = np.cumsum(PDF_y, axis=1)
+    Py_CDF = np.sort(Py_CDF, axis=1)
+    return Interp1dLinear(Py_CDF, Yhin, ranDy)
+
+
+# Prime numbers used as bases of the Halton sequence (one per dimension)
+def HaltonPrimes(dims):
+    Primes = []
+    candidate = 2
+    while len(Primes) < dims:
+        if all(candidate % p for p in Primes if p * p <= candidate):
+            Primes.append(candidate)
+        candidate += 1
+    return Primes
+
+
+# Halton sequences already generated in this process, keyed by
+# (dims, nb_pts, scramble, leap, seed)
+HaltonCache = {}
+
+# Number of points processed at once by HaltonRandomNumber (keeps temporaries in cache)
+HaltonBlockSize = 65536
+
+
+# Generate Halton sequences - point j (j=0..nb_pts-1) is the radical inverse of
+# j*leap+1 in every prime base. Points are processed in blocks, one digit per step.
+# scramble=True applies a random permutation to the digits of every base and digit
+# position (drawn from seed), leap>1 gives the leaped Halton sequence.
+# The returned array is cached and therefore read-only.
+def HaltonRandomNumber(dims, nb_pts, scramble=False, leap=1, seed=0):
+    key = (dims, nb_pts, bool(scramble), leap, seed if scramble else None)
+    if key in HaltonCache:
+        return HaltonCache[key]
+    hArr = np.empty((nb_pts, dims))
+    max_index = (nb_pts - 1) * leap + 1
+    log_nb_pts = log(max_index + 1)
+    index_type = np.uint32 if max_index < 2**32 else np.uint64
+    rng = np.random.RandomState(seed) if scramble else None
+    for i, b in enumerate(HaltonPrimes(dims)):
+        n = max(int(np.ceil(log_nb_pts / np.log(b))), 1)
+        pArr = np.float_power(b, -np.arange(1, n + 1, dtype=float))
+        if scramble:
+            Perms = [rng.permutation(b).astype(index_type) for t in range(n)]
+        base = index_type(b)
+        for first in range(0, nb_pts, HaltonBlockSize):
+            last = min(first + HaltonBlockSize, nb_pts)
+            d = np.arange(first, last, dtype=index_type) * index_type(leap) + 1
+            q = np.empty_like(d)
+            term = np.empty(len(d))
+            sum_ = np.zeros(len(d))
+            for t in range(n):
+                # d becomes the digit t, q the remaining leading digits
+                np.floor_divide(d, base, out=q)
+                d -= q * base
+                if scramble:
+                    d = Perms[t][d]
+                np.multiply(d, pArr[t], out=term)
+                sum_ += term
+                d, q = q, d
+            hArr[first:last, i] = sum_
+    hArr.setflags(write=False)
+    HaltonCache[key] = hArr
+    return hArr
+
+
+# Radical inverse of the positive integers index in base - point j of the Halton
+# sequence in base b is RadicalInverse(j + 1, b) (see HaltonRandomNumber), for any
+# range of points
+def RadicalInverse(index, base):
+    index = np.array(index, dtype=np.uint64)
+    result = np.zeros(len(index))
+    scale = 1.0 / base
+    while np.any(index):
+        index, digit = np.divmod(index, np.uint64(base))
+        result += digit * scale
+        scale /= base
+    return result
+
+
+# 3D density map (HxHyHz) sampled on the regular grid new_x, new_y, new_z.
+# The 2D distribution of any slice is taken straight from the grid by index
+# arithmetic - mode "nearest" uses the closest grid plane in z, mode "linear"
+# interpolates between the two neighbouring planes (trilinear interpolation,
+# exact in x and y because the slice is evaluated on the grid nodes) and gives
+# zero density outside of the grid.
+class RegularGridDensity(object):
+    def __init__(self, HxHyHz, new_x, new_y, new_z, mode="nearest"):
+        if mode not in ("nearest", "linear"):
+            raise ValueError("Unknown density interpolation mode: " + str(mode))
+        self.HxHyHz = np.asarray(HxHyHz, dtype=float)
+        self.new_x = new_x
+        self.new_y = new_y
+        self.new_z = new_z
+        self.mode = mode
+
+    # Density on the (new_x, new_y) grid at longitudinal position z, indexed
+    # [y, x] as expected by JDF_CORE/JDF_CORE_BATCH
+    def slice(self, z):
+        nz = len(self.new_z)
+        if nz == 1:
+            return self.HxHyHz[:, :, 0].T.copy()
+        u = (z - self.new_z[0]) / (self.new_z[-1] - self.new_z[0]) * (nz - 1)
+        if self.mode == "nearest":
+            k = int(np.clip(np.rint(u), 0, nz - 1))
+            return self.HxHyHz[:, :, k].T.copy()
+        if u < 0.0 or u > nz - 1:
+            return np.zeros((len(self.new_y), len(self.new_x)))
+        k = min(int(np.floor(u)), nz - 2)
+        t = u - k
+        plane = (1.0 - t) * self.HxHyHz[:, :, k] + t * self.HxHyHz[:, :, k + 1]
+        return plane.T.copy()
+
+
+# Joint 3D sampling - instead of deriving the 2D distribution of every slice, the
+# cumulative distributions of the density map are tabulated once: the marginal
+# in z (mass of every z plane, spread evenly over the z bin of the plane), the
+# conditional in x given the z plane and the conditional in y given the x node
+# and the z plane (planes and nodes are blended as in RegularGridDensity, mode
+# "nearest" or "linear"). Particle j of n is point j of a 3D Hammersley set -
+# (j + 0.5)/n for z, the Halton sequence in bases 2 and 3 for x and y - mapped
+# through the inverse distributions, so z grows with j and the cost does not
+# depend on the number of slices. With slice_z=(minz, StepZ) particles are
+# placed on the slice structure instead: z is moved to the nearest slice
+# position (where the density is taken) and spread over the slice length with
+# the Halton sequence in base 5, as z_hlt does for the slices.
+class JointDensitySampler(object):
+    def __init__(self, HxHyHz, new_x, new_y, new_z, mode="nearest"):
+        if mode not in ("nearest", "linear"):
+            raise ValueError("Unknown density interpolation mode: " + str(mode))
+        HxHyHz = np.asarray(HxHyHz, dtype=float)
+        self.new_x = np.asarray(new_x, dtype=float)
+        self.new_y = np.asarray(new_y, dtype=float)
+        self.new_z = np.asarray(new_z, dtype=float)
+        self.mode = mode
+        mass = np.sum(HxHyHz, axis=(0, 1))
+        self.Cz = np.cumsum(mass) / np.sum(mass)
+        # [plane, x node] and [plane, x node, y node]
+        self.Cx = np.cumsum(np.sum(HxHyHz, axis=1).T, axis=1)
+        self.Cy = np.cumsum(np.transpose(HxHyHz, (2, 0, 1)), axis=2)
+
+    # z of the quantiles u of the marginal in z
+    def z(self, u):
+        nz = len(self.new_z)
+        k = np.minimum(np.searchsorted(self.Cz, u, "right"), nz - 1)
+        below = np.concatenate(([0.0], self.Cz))[k]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cell = np.clip((u - below) / (self.Cz[k] - below), 0.0, 1.0)
+        cell[np.isnan(cell)] = 0.5
+        width = (self.new_z[-1] - self.new_z[0]) / nz
+        return self.new_z[0] + (k + cell) * width
+
+    # Indices of two neighbouring nodes of the regular grid nodes and the weight
+    # of the second one at positions x (the same node twice for "nearest")
+    def nodes(self, nodes, x, nearest=False):
+        n = len(nodes)
+        if n == 1:
+            k = np.zeros(len(x), dtype=int)
+            return k, k, np.zeros(len(x))
+        u = (x - nodes[0]) / (nodes[-1] - nodes[0]) * (n - 1)
+        if nearest:
+            k = np.clip(np.rint(u), 0, n - 1).astype(int)
+            return k, k, np.zeros(len(x))
+        k = np.clip(np.floor(u), 0, n - 2).astype(int)
+        return k, k + 1, np.clip(u - k, 0.0, 1.0)
+
+    # x and y of the quantiles ux, uy of the conditionals at the positions z
+    def xy(self, z, ux, uy):
+        k0, k1, t = self.nodes(self.new_z, z, self.mode == "nearest")
+        Cx = (1.0 - t)[:, None] * self.Cx[k0] + t[:, None] * self.Cx[k1]
+        self.fill_empty(Cx)
+        x = Interp1dLinear(Cx / Cx[:, -1:], self.new_x, ux)
+        # Rows of the two x nodes around x, as in JDF_CORE_BATCH
+        m0, m1, s = self.nodes(self.new_x, x)
+        Cy = (
+            ((1.0 - t) * (1.0 - s))[:, None] * self.Cy[k0, m0]
+            + ((1.0 - t) * s)[:, None] * self.Cy[k0, m1]
+            + (t * (1.0 - s))[:, None] * self.Cy[k1, m0]
+            + (t * s)[:, None] * self.Cy[k1, m1]
+        )
+        self.fill_empty(Cy)
+        y = Interp1dLinear(Cy / Cy[:, -1:], self.new_y, uy)
+        return x, y
+
+    # Uniform distribution for the rows of the cumulative distributions C without
+    # any density (a position next to the edge of a density bin may be closer to
+    # an empty plane)
+    @staticmethod
+    def fill_empty(C):
+        empty = C[:, -1] <= 0.0
+        if np.any(empty):
+            C[empty] = np.arange(1, C.shape[1] + 1)
+
+    # Positions (x, y, z) of the particles j (array) of n
+    def sample(self, j, n, slice_z=None):
+        z = self.z((j + 0.5) / n)
+        z_density = z
+        if slice_z is not None:
+            minz, StepZ = slice_z
+            z_density = minz + np.rint((z - minz) / StepZ) * StepZ
+            z = z_density + StepZ * (0.5 - RadicalInverse(j + 1, 5))
+        x, y = self.xy(z_density, RadicalInverse(j + 1, 2), RadicalInverse(j + 1, 3))
+        return x, y, z
+
+
+# Particles per block of the joint sampler - the blocks take the place of the
+# slices of a run (see PlanRun)
+JointBlockSize = 65536
+
+
+# Rows (x, y, z, NE) of block i of a run sampled with JointDensitySampler -
+# joint holds the number of particles n, their weight and slice_z of the run
+def JointBlockCalculate(sampler, i, count, joint):
+    j = i * JointBlockSize + np.arange(count, dtype=np.int64)
+    x, y, z = sampler.sample(j, joint["n"], joint["slice_z"])
+    return np.column_stack((x, y, z, np.full(count, joint["weight"])))
 
 
 # Routine that calculates new microparticles positions and weights for selected (just one) slice
@@ -170,141 +443,1240 @@ def SliceCalculate(
     JDFSmoothing,
     RandomHaltonSequence,
 ):
-    print "Slice ", i, " of ", NumberOfSlices
-    new_z = np.full((1), (minz + (StepZ * i)))
-    xx, yy, zz = np.meshgrid(new_x, new_y, new_z)
-    positionsin = np.column_stack(
-        (
-            xx.ravel("F"),
-            yy.ravel("F"),
-            zz.ravel("F"),
-            interpolator(xx, yy, zz).ravel("F"),
-        )
-    )
-    xy_flat = np.vstack((positionsin[:, 0], positionsin[:, 1])).T
-    hist2d_flat, edges = np.histogramdd(
-        xy_flat, bins=(bin_x_in, bin_y_in), weights=positionsin[:, 3]
-    )
-    # if np.sum(hist2d_flat)>0:
-    Dist = hist2d_flat
-    Xin = np.linspace(np.min(positionsin[:, 0]), np.max(positionsin[:, 0]), bin_x_in)
-    Yin = np.linspace(np.min(positionsin[:, 1]), np.max(positionsin[:, 1]), bin_y_in)
-    dots = []
+    # 2D density of the slice straight from the regular density grid
+    Dist = interpolator.slice(minz + (StepZ * i))
+    Xin = np.linspace(np.min(new_x), np.max(new_x), bin_x_in)
+    Yin = np.linspace(np.min(new_y), np.max(new_y), bin_y_in)
     ZZZ = minz + (i * StepZ)
     ZZZ_in = np.full((Num_Of_Slice_Particles), minz + (i * StepZ) + (StepZ * z_hlt))
     NoOfElec = (Non_Zero_Z) * (f_Z(ZZZ) / (NumberOfSlices)) / (Num_Of_Slice_Particles)
-    for j in range(0, Num_Of_Slice_Particles):
-        result = JDF_CORE(
-            f_Z,
-            Xin,
-            Yin,
-            Dist,
-            JDFSmoothing,
-            RandomHaltonSequence[j, 0],
-            RandomHaltonSequence[j, 1],
-            ZZZ_in[j],
-            NoOfElec,
-        )
-        dots.append(result[:, 0])
+    # All particles of the slice are generated at once - rows are (x, y, z, NE)
+    dots = JDF_CORE_BATCH(
+        Xin,
+        Yin,
+        Dist,
+        JDFSmoothing,
+        RandomHaltonSequence[:Num_Of_Slice_Particles, 0],
+        RandomHaltonSequence[:Num_Of_Slice_Particles, 1],
+        ZZZ_in,
+        NoOfElec,
+    )
     return dots
 
 
+# Particle files - the (N, 7) rows x, px, y, py, z, pz, NE are stored in HDF5
+# files (/Particles, with VizSchema metadata - the default), NumPy .npy files or
+# raw binary files (little-endian float64 rows, .bin, .raw or .dat). The format
+# is chosen by the file name extension.
+PARTICLE_FORMATS = {".npy": "npy", ".bin": "raw", ".raw": "raw", ".dat": "raw"}
+
+
+def ParticleFormat(file_name):
+    return PARTICLE_FORMATS.get(os.path.splitext(file_name)[1].lower(), "hdf5")
+
+
+# Input particles of file_name - Particles is the (N, 7) array of the file, read
+# with reader: "tables" (PyTables, the default for HDF5), "h5py" (HDF5 dataset
+# read slice by slice), "npy" or "raw" (memory mapped - chunks are views of the
+# file, nothing is copied), None chooses by the file name. Close when done.
+class ParticleFile(object):
+    def __init__(self, file_name, reader=None):
+        if reader is None:
+            reader = ParticleFormat(file_name)
+            if reader == "hdf5":
+                reader = "tables"
+        self.file = None
+        if reader == "tables":
+            import tables
+
+            self.file = tables.open_file(file_name, "r")
+            self.Particles = self.file.root.Particles
+        elif reader == "h5py":
+            import h5py
+
+            self.file = h5py.File(file_name, "r")
+            self.Particles = self.file["Particles"]
+        elif reader == "npy":
+            self.Particles = np.load(file_name, mmap_mode="r")
+        elif reader == "raw":
+            self.Particles = np.memmap(file_name, dtype="<f8", mode="r").reshape(-1, 7)
+        else:
+            raise ValueError("Unknown particle reader: " + str(reader))
+        if len(self.Particles.shape) != 2 or self.Particles.shape[1] != 7:
+            self.close()
+            raise ValueError(file_name + " does not hold particles with 7 columns")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.Particles = None
+
+
+# Input particles are read in chunks of chunk_rows rows (all at once if None),
+# so that beams larger than the available memory can be processed.
+# Particles is the (N, 7) array x, px, y, py, z, pz, NE - a PyTables array, an
+# h5py dataset, a memory map or anything else that has shape and supports row
+# slicing (see ParticleFile).
+def IterParticleChunks(Particles, chunk_rows=None):
+    n = Particles.shape[0]
+    chunk_rows = chunk_rows or max(n, 1)
+    for first in range(0, n, chunk_rows):
+        yield first, Particles[first : first + chunk_rows]
+
+
+# Running sum over chunks - total is a pair (sum, remainder) of correctly
+# rounded sums, so the result does not depend on how the values are chunked
+def AddChunkSum(total, values):
+    import itertools
+
+    high = fsum(itertools.chain(total, values))
+    return high, fsum(itertools.chain(total, values, (-high,)))
+
+
+# First pass over the input - number of particles, minimum and maximum of every
+# column, total weight and mean gamma (independent of the chunk size, so that
+# the number of slices derived from them is too)
+def ScanParticles(Particles, chunk_rows=None):
+    n = 0
+    col_min = np.full(Particles.shape[1], np.inf)
+    col_max = np.full(Particles.shape[1], -np.inf)
+    total_weight = (0.0, 0.0)
+    gamma_sum = (0.0, 0.0)
+    for first, chunk in IterParticleChunks(Particles, chunk_rows):
+        n += len(chunk)
+        col_min = np.minimum(col_min, np.min(chunk, axis=0))
+        col_max = np.maximum(col_max, np.max(chunk, axis=0))
+        total_weight = AddChunkSum(total_weight, chunk[:, 6])
+        # Momentum is stored as p/mc
+        gamma_sum = AddChunkSum(
+            gamma_sum,
+            np.sqrt(1.0 + chunk[:, 1] ** 2 + chunk[:, 3] ** 2 + chunk[:, 5] ** 2),
+        )
+    return {
+        "n": n,
+        "min": col_min,
+        "max": col_max,
+        "total_weight": fsum(total_weight),
+        "gamma_0": fsum(gamma_sum) / n,
+    }
+
+
+# Second pass over the input - weighted current histogram in Z (bins_z bins over
+# range_z) and 3D density histogram in X, Y, Z (bins_xyz bins over range_xyz),
+# accumulated chunk by chunk (the bin sums depend on the chunk size at round-off
+# level)
+def HistogramParticles(
+    Particles, bins_z, range_z, bins_xyz, range_xyz, chunk_rows=None
+):
+    Hz = np.zeros(bins_z)
+    HxHyHz = np.zeros(bins_xyz)
+    edges_Z = np.linspace(range_z[0], range_z[1], bins_z + 1)
+    edges_XYZ = [np.linspace(r[0], r[1], b + 1) for b, r in zip(bins_xyz, range_xyz)]
+    for first, chunk in IterParticleChunks(Particles, chunk_rows):
+        Hz += np.histogram(
+            chunk[:, 4], bins=bins_z, weights=chunk[:, 6], range=range_z
+        )[0]
+        # Columns as views - no copy of the chunk
+        HxHyHz += np.histogramdd(
+            (chunk[:, 0], chunk[:, 2], chunk[:, 4]),
+            bins=bins_xyz,
+            range=range_xyz,
+            weights=chunk[:, 6],
+        )[0]
+    return Hz, edges_Z, HxHyHz, edges_XYZ
+
+
+# Pass over the input for cropped density grids - the regular grid nodes of the
+# columns are cut to the range which holds all but the fraction of the charge
+# on either side (at least two nodes are kept), so the grid skips the empty
+# region of the bounding box around a core with a thin halo at the same grid
+# step. Returns the cropped node arrays.
+def CropNodes(Particles, columns, nodes, fraction, chunk_rows=None):
+    H = [np.zeros(len(n)) for n in nodes]
+    for first, chunk in IterParticleChunks(Particles, chunk_rows):
+        for h, column, n in zip(H, columns, nodes):
+            if len(n) > 1:
+                # Bins centered on the nodes
+                half = 0.5 * (n[-1] - n[0]) / (len(n) - 1)
+                h += np.histogram(
+                    chunk[:, column],
+                    bins=len(n),
+                    range=(n[0] - half, n[-1] + half),
+                    weights=chunk[:, 6],
+                )[0]
+    cropped = []
+    for h, n in zip(H, nodes):
+        if len(n) < 2 or np.sum(h) <= 0.0:
+            cropped.append(n)
+            continue
+        cumulative = np.cumsum(h) / np.sum(h)
+        last = max(min(np.searchsorted(cumulative, 1.0 - fraction), len(n) - 1), 1)
+        first = min(np.searchsorted(cumulative, fraction, "right"), last - 1)
+        cropped.append(n[max(first, 0) : last + 1])
+    return cropped
+
+
+# Second pass over the input for the KDE density estimator - weighted current
+# histogram in Z as in HistogramParticles and the 3D density linearly binned
+# onto the grid nodes nodes_xyz (every particle is shared between the 8 nodes
+# around it, particles outside of the nodes are dropped). The weights of a chunk
+# are summed over the occupied cells only, so no temporary grid is allocated.
+# Also returns the weighted rms of x, y, z and the effective number of particles
+# (for the bandwidth, see ScottBandwidth).
+def LinearBinParticles(Particles, bins_z, range_z, nodes_xyz, chunk_rows=None):
+    import itertools
+
+    Hz = np.zeros(bins_z)
+    edges_Z = np.linspace(range_z[0], range_z[1], bins_z + 1)
+    shape = tuple(len(nodes) for nodes in nodes_xyz)
+    grid = np.zeros(shape)
+    flat = grid.reshape(-1)
+    strides = np.array([shape[1] * shape[2], shape[2], 1])
+    sums = np.zeros(3)
+    squares = np.zeros(3)
+    weight = weight2 = 0.0
+    for first, chunk in IterParticleChunks(Particles, chunk_rows):
+        w = chunk[:, 6]
+        Hz += np.histogram(chunk[:, 4], bins=bins_z, weights=w, range=range_z)[0]
+        # Columns as views - no copy of the chunk
+        xyz = (chunk[:, 0], chunk[:, 2], chunk[:, 4])
+        weight += np.sum(w)
+        weight2 += np.dot(w, w)
+        for axis, column in enumerate(xyz):
+            sums[axis] += np.dot(w, column)
+            squares[axis] += np.dot(w, column**2)
+        inside = np.ones(len(chunk), dtype=bool)
+        cell = np.zeros(len(chunk), dtype=np.int64)
+        fractions = []
+        for axis, nodes in enumerate(nodes_xyz):
+            n = len(nodes)
+            u = np.zeros(len(chunk))
+            if n > 1:
+                u = (xyz[axis] - nodes[0]) / (nodes[-1] - nodes[0]) * (n - 1)
+            inside &= (u >= 0.0) & (u <= n - 1)
+            k = np.clip(np.floor(u), 0, max(n - 2, 0)).astype(np.int64)
+            cell += k * strides[axis]
+            fractions.append(u - k)
+        w = w[inside]
+        fractions = [t[inside] for t in fractions]
+        cells, index = np.unique(cell[inside], return_inverse=True)
+        for corner in itertools.product((0, 1), repeat=3):
+            if any(d and n == 1 for d, n in zip(corner, shape)):
+                continue
+            corner_w = w.copy()
+            for d, t in zip(corner, fractions):
+                corner_w *= t if d else 1.0 - t
+            flat[cells + np.dot(corner, strides)] += np.bincount(
+                index, weights=corner_w, minlength=len(cells)
+            )
+    mean = sums / weight
+    rms = np.sqrt(np.maximum(squares / weight - mean**2, 0.0))
+    return Hz, edges_Z, grid, {"rms": rms, "n_eff": weight**2 / weight2}
+
+
+# Bandwidths of a Gaussian kernel density estimate in d dimensions by Scott's
+# rule - rms * n_eff^(-1/(d + 4)) per axis
+def ScottBandwidth(rms, n_eff, d=3):
+    return np.asarray(rms) * n_eff ** (-1.0 / (d + 4))
+
+
+# Gaussian kernel density estimate from the linearly binned grid - the grid is
+# convolved in place along every axis with a Gaussian of sigma[axis] grid steps
+# by FFT, one plane at a time (zero padded by 4 sigma, so no density wraps
+# around the grid; what is smoothed beyond the grid is dropped)
+def KernelDensity(grid, sigma):
+    from scipy import fft
+
+    for axis, s in enumerate(sigma):
+        n = grid.shape[axis]
+        if s <= 0.0 or n == 1:
+            continue
+        length = fft.next_fast_len(n + int(ceil(4.0 * s)), real=True)
+        kernel = np.exp(-2.0 * (Pi * s * fft.rfftfreq(length)) ** 2)
+        for plane in np.moveaxis(grid, axis, -1):
+            spectrum = fft.rfft(plane, length, axis=-1) * kernel
+            plane[:] = fft.irfft(spectrum, length, axis=-1)[:, :n]
+    np.maximum(grid, 0.0, out=grid)
+    return grid
+
+
+# Positions (x, y, z) and momenta (px, py, pz in p/mc) of every stride-th input
+# particle, for the momentum interpolation - read chunk by chunk into one buffer
+# of type dtype
+def ReadMomentumPoints(Particles, chunk_rows=None, stride=1, dtype=float):
+    n = len(range(0, Particles.shape[0], stride))
+    points = np.empty((n, 3), dtype=dtype)
+    momenta = np.empty((n, 3), dtype=dtype)
+    row = 0
+    for first, chunk in IterParticleChunks(Particles, chunk_rows):
+        chunk = chunk[(-first) % stride :: stride]
+        points[row : row + len(chunk)] = chunk[:, [0, 2, 4]]
+        momenta[row : row + len(chunk)] = chunk[:, [1, 3, 5]]
+        row += len(chunk)
+    return points, momenta
+
+
+# Output buffer and read-only data of the slice worker processes (set by InitSliceWorker)
+SliceWorkerState = {}
+
+
+# Every worker receives the shared output buffers (flat ctypes arrays of the
+# working dtype with one (particles x 4) block per slice, written in place
+# instead of being sent back to the parent) and beam_args - the arguments of
+# SliceCalculate that depend on the input beam only - and the JointDensitySampler
+# of the beam (if any) once, when the pool is started
+def InitSliceWorker(buffers, beam_args, sampler=None):
+    SliceWorkerState["buffers"] = [np.ctypeslib.as_array(b) for b in buffers]
+    SliceWorkerState["beam_args"] = beam_args
+    SliceWorkerState["sampler"] = sampler
+
+
+# Add the noise to the rows (x, y, z, NE) of slice i - a random shift of z within
+# the slice (shot noise, smaller for larger weights) and Poisson noise on the
+# weights. Every slice has its own random stream, spawned from RNG_seed with the
+# slice number as key, so the noise does not depend on which process computes
+# the slice, on the order the slices are done in or on the shard of the slice.
+def SliceNoise(rows, RNG_seed, i, StepZ):
+    rng = np.random.default_rng(np.random.SeedSequence(int(RNG_seed), spawn_key=(i,)))
+    rows[:, 2] += (StepZ * (rng.random(len(rows)) - 0.50)) / np.sqrt(rows[:, 3])
+    rows[:, 3] = rng.poisson(rows[:, 3])
+
+
+# Calculate the slices slice_numbers of one run with counts particles each and
+# store them one after another in the shared buffer buffer_index, starting at
+# row first, with the noise of every slice added (see SliceNoise). run_args are
+# StepZ, NumberOfSlices, MaxSliceParticles (largest count), RNG_seed and joint
+# of the run - with joint (see PlanRun) the "slices" are the blocks of the joint
+# sampler (see JointBlockCalculate). Returns the rows and the number of slices
+# done and the time the worker was busy with them.
+def SliceRangeWorker(task):
+    start = time.time()
+    buffer_index, first, slice_numbers, counts, run_args = task
+    last = first + sum(counts)
+    buffer = SliceWorkerState["buffers"][buffer_index]
+    rows = buffer[: last * 4].reshape(last, 4)
+    joint = run_args["joint"]
+    if joint is None:
+        # Slices with fewer particles use the beginning of the same sequence
+        RandomHaltonSequence = HaltonRandomNumber(2, run_args["MaxSliceParticles"])
+        z_hlt = 0.5 - RandomHaltonSequence[:, 1]
+    row = first
+    for i, count in zip(slice_numbers, counts):
+        block = rows[row : row + count]
+        if joint is not None:
+            block[:] = JointBlockCalculate(SliceWorkerState["sampler"], i, count, joint)
+        else:
+            block[:] = SliceCalculate(
+                i=i,
+                z_hlt=z_hlt[:count],
+                StepZ=run_args["StepZ"],
+                NumberOfSlices=run_args["NumberOfSlices"],
+                Num_Of_Slice_Particles=count,
+                RandomHaltonSequence=RandomHaltonSequence,
+                **SliceWorkerState["beam_args"]
+            )
+        SliceNoise(block, run_args["RNG_seed"], i, run_args["StepZ"])
+        row += count
+    return first, last, len(slice_numbers), time.time() - start
+
+
+# Split slices with counts particles each into parts consecutive ranges with
+# about the same number of particles (some may be empty). Returns (first, last).
+def BalancedRanges(counts, parts):
+    n = len(counts)
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1] if n else 0
+    # Range k ends behind the slice at which the particle count reaches
+    # (k + 1)/parts of the total
+    ends = np.searchsorted(cumulative, total * np.arange(1, parts) / float(parts))
+    bounds = np.concatenate(([0], np.minimum(ends + 1, n), [n]))
+    bounds = np.maximum.accumulate(bounds)
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+# Split the slices of a run with counts particles each into tasks of chunksize
+# consecutive slices - by default into about four tasks per worker process with
+# about the same number of particles, which keeps the workers evenly loaded
+# also when the slices differ in size
+def SliceRanges(counts, chunksize=None, processes=None):
+    n = len(counts)
+    if chunksize is not None:
+        return [(first, min(first + chunksize, n)) for first in range(0, n, chunksize)]
+    processes = processes or multiprocessing.cpu_count()
+    ranges = BalancedRanges(counts, min(4 * processes, n))
+    return [(first, last) for first, last in ranges if last > first]
+
+
+# Tasks for SliceRangeWorker computing all slices of a run (see PlanRun) into
+# the shared buffer buffer_index - or only the slices which are not done (a
+# boolean mask over the slices, see RunCheckpoint)
+def SliceTasks(run, buffer_index, chunksize=None, processes=None, done=None):
+    counts = run["slice_counts"]
+    run_args = dict(
+        StepZ=run["StepZ"],
+        NumberOfSlices=run["NumberOfSlices"],
+        MaxSliceParticles=max(counts) if counts else 0,
+        RNG_seed=run["RNG_seed"],
+        joint=run.get("joint"),
+    )
+    slice_list = run["slice_list"]
+    rows = np.concatenate(([0], np.cumsum(counts))).astype(int)
+    # Consecutive slices which are not done
+    groups = [(0, len(counts))]
+    if done is not None:
+        edges = np.flatnonzero(np.diff(np.concatenate(([1], done, [1]))))
+        groups = zip(edges[::2], edges[1::2])
+    tasks = []
+    for start, end in groups:
+        for first, last in SliceRanges(counts[start:end], chunksize, processes):
+            tasks.append(
+                (
+                    buffer_index,
+                    int(rows[start + first]),
+                    slice_list[start + first : start + last],
+                    counts[start + first : start + last],
+                    run_args,
+                )
+            )
+    return tasks
+
+
+# Momentum mapping - the input particles are triangulated once and all momentum
+# components are interpolated from that single triangulation (the results of
+# interpolate.griddata(..., method="linear", rescale=True) for every component,
+# up to round-off - about 1e-14 relative, from the different evaluation order).
+# Query points are split into chunks which are evaluated by a pool of processes.
+
+# Interpolator of the momentum worker processes (set by InitMomentumWorker)
+MomentumWorkerState = {}
+
+
+# Delaunay triangulation of the input points rescaled to the unit cube
+# (the rescaling used by griddata with rescale=True)
+def MomentumTriangulation(points):
+    from scipy.spatial import Delaunay
+
+    # Rescaled in place in one float64 copy of the points
+    offset = np.mean(points, axis=0, dtype=float)
+    scaled = np.array(points, dtype=float)
+    scaled -= offset
+    scale = np.ptp(scaled, axis=0)
+    scale[~(scale > 0)] = 1.0
+    scaled /= scale
+    return Delaunay(scaled), offset, scale
+
+
+def InitMomentumWorker(triangulation, values, offset, scale):
+    from scipy import interpolate
+
+    MomentumWorkerState["interpolator"] = interpolate.LinearNDInterpolator(
+        triangulation, values
+    )
+    MomentumWorkerState["offset"] = offset
+    MomentumWorkerState["scale"] = scale
+
+
+def MomentumWorker(query):
+    query = (query - MomentumWorkerState["offset"]) / MomentumWorkerState["scale"]
+    return MomentumWorkerState["interpolator"](query)
+
+
+# Momentum interpolation in z windows, for inputs too large for one global
+# triangulation - query points are split along z into windows with about
+# window_points input points each. Every window is interpolated from the input
+# points within its z range, extended by overlap times its length on both sides
+# (and to at least window_points points): they are triangulated on their own
+# (rescaled to the unit cube like MomentumTriangulation) and interpolated
+# linearly, query points outside of their hull get the values of the nearest
+# input point. So the cost grows linearly with the number of input points and
+# no particle gets NaN momenta. points (N x 3) must be sorted by z.
+class WindowedInterpolator(object):
+    def __init__(self, points, values, overlap=0.1, window_points=10000):
+        self.points = points
+        self.values = values
+        self.z = points[:, 2]
+        self.overlap = overlap
+        self.window_points = window_points
+
+    def __call__(self, query):
+        result = np.empty((len(query),) + self.values.shape[1:])
+        if len(query) == 0:
+            return result
+        order = np.argsort(query[:, 2], kind="stable")
+        z = query[order, 2]
+        # Window edges - every window_points-th input point in the z range
+        first = np.searchsorted(self.z, z[0], "left")
+        last = np.searchsorted(self.z, z[-1], "right")
+        count = max(int(ceil((last - first) / float(self.window_points))), 1)
+        edges = np.linspace(first, last, count + 1).astype(int)[1:-1]
+        for rows in np.split(order, np.searchsorted(z, self.z[edges])):
+            if len(rows):
+                result[rows] = self.interpolate_window(query[rows])
+        return result
+
+    # Input rows first to last of the window for query z values in zmin...zmax
+    def window(self, zmin, zmax):
+        margin = self.overlap * (zmax - zmin)
+        first = np.searchsorted(self.z, zmin - margin, "left")
+        last = np.searchsorted(self.z, zmax + margin, "right")
+        if last - first < self.window_points:
+            first = max((first + last - self.window_points) // 2, 0)
+            last = min(first + self.window_points, len(self.z))
+            first = max(last - self.window_points, 0)
+        return first, last
+
+    # Values at the query points of one window
+    def interpolate_window(self, query):
+        from scipy import interpolate
+        from scipy.spatial import cKDTree, Delaunay, QhullError
+
+        first, last = self.window(np.min(query[:, 2]), np.max(query[:, 2]))
+        points = np.array(self.points[first:last], dtype=float)
+        values = self.values[first:last]
+        offset = np.mean(points, axis=0)
+        points -= offset
+        scale = np.ptp(points, axis=0)
+        scale[~(scale > 0)] = 1.0
+        points /= scale
+        query = (query - offset) / scale
+        result = np.full((len(query),) + values.shape[1:], np.nan)
+        try:
+            result[:] = interpolate.LinearNDInterpolator(Delaunay(points), values)(
+                query
+            )
+        except QhullError:
+            # Too few or degenerate points - nearest values only
+            pass
+        outside = np.isnan(result).reshape(len(query), -1).any(axis=1)
+        if np.any(outside):
+            nearest = cKDTree(points).query(query[outside])[1]
+            result[outside] = values[nearest]
+        return result
+
+
+def InitWindowedMomentumWorker(interpolator):
+    MomentumWorkerState["interpolator"] = interpolator
+    MomentumWorkerState["offset"] = 0.0
+    MomentumWorkerState["scale"] = 1.0
+
+
+# Start the momentum workers for values (N x columns) known at points (N x 3),
+# triangulation is the result of MomentumTriangulation(points) if already known.
+# windows=(overlap, min_points) interpolates in z windows instead (see
+# WindowedInterpolator, points sorted by z). Returns a pool of processes for
+# IterMomentumMapping - or None, in which case the interpolator is set up in
+# this process (processes == 1, or no query will have more than max_rows rows,
+# i.e. a single chunk). Stop with StopMomentumPool.
+def StartMomentumPool(
+    points,
+    values,
+    processes=None,
+    max_rows=None,
+    chunk_rows=100000,
+    triangulation=None,
+    windows=None,
+):
+    if windows is not None:
+        initializer = InitWindowedMomentumWorker
+        initargs = (WindowedInterpolator(points, values, *windows),)
+    else:
+        if triangulation is None:
+            triangulation = MomentumTriangulation(points)
+        triangulation, offset, scale = triangulation
+        initializer = InitMomentumWorker
+        initargs = (triangulation, values, offset, scale)
+    if processes == 1 or (max_rows is not None and max_rows <= chunk_rows):
+        initializer(*initargs)
+        return None
+    return multiprocessing.Pool(processes, initializer=initializer, initargs=initargs)
+
+
+def StopMomentumPool(pool):
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+    MomentumWorkerState.clear()
+
+
+# Interpolate onto query (M x 3) with the momentum workers started by
+# StartMomentumPool. Yields (first_row, last_row, values_of_rows) for consecutive
+# chunks of query, in order, while the remaining chunks are still being computed.
+def IterMomentumMapping(query, pool=None, chunk_rows=100000):
+    bounds = list(range(0, len(query), chunk_rows)) + [len(query)]
+    chunks = [query[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+    if pool is None:
+        results = map(MomentumWorker, chunks)
+    else:
+        results = pool.imap(MomentumWorker, chunks)
+    for a, b, result in zip(bounds[:-1], bounds[1:], results):
+        yield a, b, result
+
+
+# Output file writer - particles are appended block by block to a chunked,
+# compressed (complevel 0 switches compression off) /Particles array with the
+# VizSchema metadata used by VisIt. Particles with weight <= 0 or NaN values
+# are dropped while appending, the weights are rescaled in place on close().
+# resume=(rows, total_weight) continues an existing out_file instead, keeping its
+# first rows particles (with the sum of weights total_weight).
+class ParticleWriter(object):
+    def __init__(
+        self,
+        out_file,
+        source_file,
+        expectedrows=None,
+        complevel=1,
+        complib="zlib",
+        chunk_rows=None,
+        resume=None,
+    ):
+        import tables
+
+        if resume is not None:
+            self.output_file = tables.open_file(out_file, "a")
+            self.ParticleGroup = self.output_file.root.Particles
+            self.ParticleGroup.truncate(resume[0])
+            self.total_weight = resume[1]
+            return
+        self.output_file = tables.open_file(out_file, "w")
+        filters = None
+        if complevel:
+            filters = tables.Filters(complevel=complevel, complib=complib, shuffle=True)
+        # Create Group in HDF5 and add metadata for Visit
+        self.ParticleGroup = self.output_file.create_earray(
+            "/",
+            "Particles",
+            tables.Float64Atom(),
+            shape=(0, 7),
+            filters=filters,
+            expectedrows=expectedrows or 1000000,
+            chunkshape=(chunk_rows, 7) if chunk_rows else None,
+        )
+        boundsGroup = self.output_file.create_group("/", "globalGridGlobalLimits", "")
+        boundsGroup._v_attrs.vsType = "limits"
+        boundsGroup._v_attrs.vsKind = "Cartesian"
+        timeGroup = self.output_file.create_group("/", "time", "time")
+        timeGroup._v_attrs.vsType = "time"
+        ParticleGroup = self.ParticleGroup
+        ParticleGroup._v_attrs.vsType = "variableWithMesh"
+        ParticleGroup._v_attrs.vsTimeGroup = "time"
+        ParticleGroup._v_attrs.vsNumSpatialDims = 3
+        ParticleGroup._v_attrs.vsLimits = "globalGridGlobalLimits"
+        ParticleGroup._v_attrs.vsLabels = "x,px,y,py,z,pz,NE"
+        now = datetime.datetime.now()
+        ParticleGroup._v_attrs.FXFELConversionTime = now.strftime("%Y-%m-%d %H:%M:%S")
+        ParticleGroup._v_attrs.FXFELSourceFileName = source_file
+        self.total_weight = 0.0
+
+    # Append a block of (x, px, y, py, z, pz, NE) rows
+    def append(self, x_px_y_py_z_pz_NE):
+        # Remove all particles with weights <= zero and particles with NaN values -
+        # it sometimes happen when using 'linear' option in momentum interpolations
+        keep = (x_px_y_py_z_pz_NE[:, 6] > 0) & ~np.any(
+            np.isnan(x_px_y_py_z_pz_NE), axis=1
+        )
+        x_px_y_py_z_pz_NE = x_px_y_py_z_pz_NE[keep]
+        self.total_weight += np.sum(x_px_y_py_z_pz_NE[:, 6])
+        self.ParticleGroup.append(x_px_y_py_z_pz_NE)
+
+    # Number of particles written
+    @property
+    def nrows(self):
+        return self.ParticleGroup.nrows
+
+    # The particles written so far, as an array which can be read and changed
+    def particles(self):
+        return self.ParticleGroup
+
+    # Write everything appended so far to the file
+    def flush(self):
+        self.output_file.flush()
+
+    # Scale the weights so that they sum up to total_weight (if given), close the
+    # file and return the scaling factor
+    def close(self, total_weight=None, chunk_rows=1000000):
+        ChargeFactor = 1.0
+        if total_weight is not None and self.total_weight > 0:
+            ChargeFactor = total_weight / self.total_weight
+            n = self.ParticleGroup.nrows
+            for first in range(0, n, chunk_rows):
+                last = min(first + chunk_rows, n)
+                self.ParticleGroup[first:last, 6] = (
+                    self.ParticleGroup[first:last, 6] * ChargeFactor
+                )
+            self.total_weight = self.total_weight * ChargeFactor
+        self.output_file.close()
+        return ChargeFactor
+
+
+# Output file writer for .npy and raw binary files (see ParticleFormat) with the
+# interface of ParticleWriter - rows are appended to the file as they come, the
+# .npy header (with room for any number of rows) is updated on flush() and
+# close(). The weights are rescaled in place through a memory map.
+class BinaryParticleWriter(object):
+    # Size of the .npy header in bytes
+    header_size = 128
+
+    def __init__(
+        self,
+        out_file,
+        source_file=None,
+        expectedrows=None,
+        complevel=1,
+        complib="zlib",
+        chunk_rows=None,
+        resume=None,
+    ):
+        self.out_file = out_file
+        self.offset = self.header_size if ParticleFormat(out_file) == "npy" else 0
+        self.mapped = None
+        if resume is not None:
+            self.nrows, self.total_weight = resume
+            self.output_file = open(out_file, "r+b")
+            self.output_file.truncate(self.offset + self.nrows * 7 * 8)
+        else:
+            self.nrows, self.total_weight = 0, 0.0
+            self.output_file = open(out_file, "wb")
+        self.write_header()
+
+    # .npy header for the rows written so far, the file position is left at its end
+    def write_header(self):
+        if self.offset:
+            header = "{'descr': '<f8', 'fortran_order': False, 'shape': (%d, 7), }"
+            header = (header % self.nrows).ljust(self.header_size - 11) + "\n"
+            self.output_file.seek(0)
+            self.output_file.write(
+                b"\x93NUMPY\x01\x00"
+                + np.array(len(header), dtype="<u2").tobytes()
+                + header.encode("latin1")
+            )
+        self.output_file.seek(0, os.SEEK_END)
+
+    # Append a block of (x, px, y, py, z, pz, NE) rows (see ParticleWriter.append)
+    def append(self, x_px_y_py_z_pz_NE):
+        keep = (x_px_y_py_z_pz_NE[:, 6] > 0) & ~np.any(
+            np.isnan(x_px_y_py_z_pz_NE), axis=1
+        )
+        x_px_y_py_z_pz_NE = x_px_y_py_z_pz_NE[keep]
+        self.total_weight += np.sum(x_px_y_py_z_pz_NE[:, 6])
+        self.output_file.write(np.ascontiguousarray(x_px_y_py_z_pz_NE, "<f8").tobytes())
+        self.nrows += len(x_px_y_py_z_pz_NE)
+
+    # The particles written so far, as a memory map of the file
+    def particles(self):
+        self.flush()
+        if self.mapped is None or len(self.mapped) != self.nrows:
+            self.mapped = np.memmap(
+                self.out_file,
+                dtype="<f8",
+                mode="r+",
+                offset=self.offset,
+                shape=(self.nrows, 7),
+            )
+        return self.mapped
+
+    def flush(self):
+        self.write_header()
+        self.output_file.flush()
+
+    # Scale the weights so that they sum up to total_weight (if given), close the
+    # file and return the scaling factor
+    def close(self, total_weight=None, chunk_rows=1000000):
+        ChargeFactor = 1.0
+        if total_weight is not None and self.total_weight > 0 and self.nrows:
+            ChargeFactor = total_weight / self.total_weight
+            Particles = self.particles()
+            for first in range(0, self.nrows, chunk_rows):
+                Particles[first : first + chunk_rows, 6] *= ChargeFactor
+            self.total_weight = self.total_weight * ChargeFactor
+        if self.mapped is not None:
+            self.mapped.flush()
+            self.mapped = None
+        self.write_header()
+        self.output_file.close()
+        return ChargeFactor
+
+
+# Writer for out_file in the format of its name (see ParticleFormat)
+def OpenParticleWriter(out_file, source_file, **kwargs):
+    if ParticleFormat(out_file) == "hdf5":
+        return ParticleWriter(out_file, source_file, **kwargs)
+    return BinaryParticleWriter(out_file, source_file, **kwargs)
+
+
+# Downsampling - reduces the input to about target particles in two streaming
+# passes over the input (linear time, memory independent of the input size).
+# Particles are picked by systematic resampling along the input rows: with the
+# step W/target (W - total weight) and one random offset, every particle gets
+# as many picks as multiples of the step its cumulative weight crosses and is
+# kept with weight picks * W/target. The total charge is conserved exactly,
+# the moments in expectation; with match_moments the mean and rms of every
+# coordinate and momentum are then matched to the input by an affine correction
+# of the new particles (in place in the output file).
+
+
+# Weighted mean and rms of the columns 0-5 of Particles and the total weight,
+# read in chunks
+def ParticleMoments(Particles, chunk_rows=None):
+    weight = 0.0
+    sums = np.zeros(6)
+    squares = np.zeros(6)
+    for first, chunk in IterParticleChunks(Particles, chunk_rows):
+        w = chunk[:, 6]
+        weight += np.sum(w)
+        sums += np.dot(w, chunk[:, :6])
+        squares += np.dot(w, chunk[:, :6] ** 2)
+    mean = sums / weight
+    rms = np.sqrt(np.maximum(squares / weight - mean**2, 0.0))
+    return mean, rms, weight
+
+
+# Downsample file_name_in (read with reader, see ParticleFile) to about target
+# particles written to out_file - seed initializes the random offset of the
+# picks. Returns a dict with a summary.
+def DownsampleParticles(
+    file_name_in,
+    out_file,
+    target,
+    seed=None,
+    match_moments=True,
+    chunk_rows=1000000,
+    complevel=1,
+    reader=None,
+):
+    start = time.time()
+    f = ParticleFile(file_name_in, reader)
+    Particles = f.Particles
+    mean_in, rms_in, TotalNumberOfElectrons = ParticleMoments(Particles, chunk_rows)
+    step = TotalNumberOfElectrons / target
+    offset = np.random.RandomState(seed).random_sample()
+
+    writer = OpenParticleWriter(
+        out_file, file_name_in, expectedrows=target, complevel=complevel
+    )
+    cumulative = 0.0
+    for first, chunk in IterParticleChunks(Particles, chunk_rows):
+        # picks = number of positions (k + offset) * step in the cumulative
+        # weight interval of every particle
+        edges = np.cumsum(chunk[:, 6])
+        edges += cumulative
+        picks = np.diff(
+            np.floor(edges / step - offset),
+            prepend=np.floor(cumulative / step - offset),
+        )
+        cumulative = edges[-1]
+        keep = picks > 0
+        chunk = chunk[keep]
+        chunk[:, 6] = picks[keep] * step
+        writer.append(chunk)
+    f.close()
+
+    if match_moments and writer.nrows > 1:
+        New = writer.particles()
+        mean_out, rms_out, weight = ParticleMoments(New, chunk_rows)
+        scale = np.ones(6)
+        scale[rms_out > 0] = rms_in[rms_out > 0] / rms_out[rms_out > 0]
+        for first in range(0, writer.nrows, chunk_rows):
+            last = min(first + chunk_rows, writer.nrows)
+            block = New[first:last]
+            block[:, :6] = mean_in + (block[:, :6] - mean_out) * scale
+            New[first:last] = block
+
+    Total_Number_Of_Particles = writer.nrows
+    ChargeFactor = writer.close(TotalNumberOfElectrons)
+    print("Downsampled to", Total_Number_Of_Particles, "particles")
+    print("Charge scaling factor = ", ChargeFactor)
+    print("Final charge of particles = ", writer.total_weight * e_ch)
+    end = time.time()
+    print("Time of work: ", end - start)
+    return {
+        "out_file": out_file,
+        "RNG_seed": seed,
+        "Total_Number_Of_Particles": Total_Number_Of_Particles,
+        "ChargeFactor": ChargeFactor,
+        "Time_of_work": end - start,
+    }
+
+
 ##################################################################
 ##################################################################
 ##################################################################
 
 
-# Main routine for JDF
-if __name__ == "__main__":
+# Parameters read from the parameters file (PARAMS_JDF.py) with their default
+# values - RNG_seed None draws a random seed, out_file None gives the default name
+JDF_PARAMETERS = {
+    "k_u": 228.4727,
+    "a_u": 1.0121809,
+    "SlicesMultiplyFactor": 10,
+    "NumOfSliceParticles": 800,
+    "X_DensitySampling": 40,
+    "Y_DensitySampling": 40,
+    "Z_DensitySampling": 40,
+    "BeamStretchFactor": 0.0,
+    "DensityInterpolation": "nearest",
+    "DensityEstimator": "histogram",
+    "DensityBandwidth": None,
+    "DensityCrop": 0.0,
+    "InputChunkSize": None,
+    "MomentumSampleSize": None,
+    "OutputCompression": 1,
+    "SliceProcesses": None,
+    "SliceChunkSize": None,
+    "MomentumProcesses": None,
+    "MomentumChunkSize": 100000,
+    "RNG_seed": None,
+    "out_file": None,
+    "ProgressInterval": 10.0,
+    "RunReport": True,
+    "CacheDir": None,
+    "CacheSize": 2000,
+    "WorkingDtype": "float64",
+    "AdaptiveSliceParticles": False,
+    "SliceParticlesMin": 50,
+    "ParticleBudget": None,
+    "MomentumEngine": "delaunay",
+    "MomentumWindowOverlap": 0.1,
+    "MomentumWindowPoints": 10000,
+    "InputReader": None,
+    "SamplingMode": "slices",
+    "JointSliceZ": False,
+    "MaxMemory": None,
+    "CheckpointInterval": None,
+    "Resume": False,
+}
+
+
+# Set default parameters and read from parameters file - params_module is the
+# name of a module on the path or a path to a .py file (None - defaults only),
+# params is a dict of values overriding both
+def ReadParameters(params=None, params_module="PARAMS_JDF"):
+    values = dict(JDF_PARAMETERS)
+    module = None
+    if params_module is not None and params_module.endswith(".py"):
+        spec = importlib.util.spec_from_file_location("PARAMS_JDF", params_module)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    elif params_module is not None:
+        try:
+            module = importlib.import_module(params_module)
+        except ImportError:
+            print("No parameters file", params_module, "found, using defaults")
+    for name in values:
+        if hasattr(module, name):
+            values[name] = getattr(module, name)
+    for name in params or {}:
+        if name not in values:
+            raise ValueError("Unknown JDF parameter: " + name)
+        values[name] = params[name]
+    return values
+
+
+# Plot of the current profile f_Z along z, written to plot_file (format given
+# by the extension, e.g. .png or .pdf) - no window is opened
+def PlotCurrentProfile(f_Z, m_Z_plt, plot_file):
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    ax = fig.add_subplot(111)
+    ax.plot(m_Z_plt, f_Z(m_Z_plt))
+    ax.set_xlabel("z")
+    ax.set_ylabel("current profile")
+    fig.savefig(plot_file)
+
+
+# *************************************************************
+# The below section calculates size of the bin according
+# to value of Lc (binnumbers=total_length/Lc)
+# USER DATA - MODIFY ACCORDING TO REQUIREMENTS
+Pi = np.pi  # Pi number taken from 'numpy' as more precise than just 3.1415
+c = 299792458.0  # Speed of light
+m = 9.11e-31  # mass of electron
+e_0 = 8.854e-12  # vacuum permitivity
+e_ch = 1.602e-19  # charge of one electron
+
+# *************************************************************
+
+
+# Wall times of the pipeline stages - times[name] accumulates the time spent in
+# "with StageTimer(times, name):" blocks
+class StageTimer(object):
+    def __init__(self, times, name):
+        self.times = times
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.time() - self.start
+        self.times[self.name] = self.times.get(self.name, 0.0) + elapsed
+        return False
+
+
+# Progress of a loop over total items - printed at most every interval seconds
+# (and when done) with the rate and the estimated time to completion
+class Progress(object):
+    def __init__(self, label, total, interval=10.0):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start = time.time()
+        self.last = self.start
+
+    def update(self, count=1):
+        self.done += count
+        now = time.time()
+        if now - self.last < self.interval and self.done < self.total:
+            return
+        self.last = now
+        rate = self.done / max(now - self.start, 1e-9)
+        eta = (self.total - self.done) / rate if rate > 0 else float("inf")
+        print(
+            "%s %d of %d (%.1f%%), %.1f/s, ETA %.0f s"
+            % (
+                self.label,
+                self.done,
+                self.total,
+                100.0 * self.done / max(self.total, 1),
+                rate,
+                eta,
+            )
+        )
+        sys.stdout.flush()
 
-    if len(sys.argv) == 2:
-        file_name_in = sys.argv[1]
-        print "Processing file:", file_name_in
-    else:
-        print "Usage: JDF_NLIST <Input File Name>\n"
-        sys.exit(1)
-    file_name_base = file_name_base = (".".join(file_name_in.split(".")[:-1])).strip()
 
-    import PARAMS_JDF
+# Peak resident set size in MB of this process and of its finished (joined)
+# child processes - None where the resource module is not available
+def PeakRSS():
+    try:
+        import resource
+    except ImportError:
+        return {"self": None, "children": None}
+    # ru_maxrss is in kB on Linux, in bytes on macOS
+    unit = 1024.0**2 if sys.platform == "darwin" else 1024.0
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit,
+    }
+
+
+# Write the JSON report of a run (summary of WriteRun completed by
+# run_jdf_sweep) to the output file name + "_report.json"
+def WriteRunReport(result, P):
+    import json
+    import platform
+
+    report = dict(result)
+    report["parameters"] = P
+    report["peak_rss_mb"] = PeakRSS()
+    report["host"] = platform.node()
+    report["cpu_count"] = multiprocessing.cpu_count()
+    report["python"] = platform.python_version()
+    report["numpy"] = np.__version__
+    report["date"] = datetime.datetime.now().isoformat()
+    report_file = os.path.splitext(result["out_file"])[0] + "_report.json"
+    with open(report_file, "w") as out:
+        json.dump(report, out, indent=2, default=str)
+    return report_file
+
+
+# Iterate over iterable - the time spent waiting for its items is added to
+# times[name]
+def TimedIter(iterable, times, name):
+    iterator = iter(iterable)
+    while True:
+        with StageTimer(times, name):
+            item = next(iterator, StopIteration)
+        if item is StopIteration:
+            return
+        yield item
+
+
+# Beam cache - the beam model of ReadBeamModel and the triangulation of the
+# momentum mapping are stored as .npz files in a cache directory. The key is
+# a hash of the input file content and of the parameters the model depends on,
+# the least recently used files are removed when the cache grows larger than
+# its size limit.
+
+# Parameters the beam model depends on, format version of the cache files
+BEAM_CACHE_PARAMETERS = (
+    "k_u",
+    "a_u",
+    "X_DensitySampling",
+    "Y_DensitySampling",
+    "Z_DensitySampling",
+    "BeamStretchFactor",
+    "MomentumSampleSize",
+    "MomentumEngine",
+    "DensityEstimator",
+    "DensityBandwidth",
+    "DensityCrop",
+    "WorkingDtype",
+)
+BEAM_CACHE_VERSION = 3
+
+
+def BeamCacheKey(file_name_in, P, block_size=16 * 1024**2):
+    import hashlib
+    import scipy
+
+    digest = hashlib.sha256()
+    with open(file_name_in, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    for name in BEAM_CACHE_PARAMETERS:
+        digest.update(("%s=%r;" % (name, P[name])).encode())
+    digest.update(("version=%d" % BEAM_CACHE_VERSION).encode())
+    # The triangulation is restored from the private state of scipy's Delaunay
+    # object, which may differ between versions
+    digest.update(("numpy=%s;scipy=%s" % (np.__version__, scipy.__version__)).encode())
+    return digest.hexdigest()
+
+
+# The beam model as a dict of arrays for np.savez - the Delaunay triangulation
+# (if any - not with the windowed MomentumEngine) is stored as its arrays (the
+# qhull object itself is released after the triangulation is built), attributes
+# which are None are listed in tri_none
+def BeamCacheArrays(model):
+    arrays = {}
+    if "triangulation" in model:
+        triangulation, offset, scale = model["triangulation"]
+        none = []
+        for name, value in vars(triangulation).items():
+            if value is None:
+                none.append(name)
+            else:
+                arrays["tri" + name] = np.asarray(value)
+        arrays["tri_none_"] = np.array(none, dtype=str)
+        arrays["tri_offset_"] = offset
+        arrays["tri_scale_"] = scale
+    for name, value in model.items():
+        if name != "triangulation":
+            arrays[name] = np.asarray(value)
+    return arrays
+
+
+# Inverse of BeamCacheArrays
+def BeamCacheModel(arrays):
+    from scipy.spatial import Delaunay
+
+    model = {}
+    state = {}
+    for name in arrays.files:
+        value = arrays[name]
+        if value.ndim == 0:
+            value = value.item()
+        if name in ("tri_none_", "tri_offset_", "tri_scale_"):
+            continue
+        elif name.startswith("tri"):
+            state[name[3:]] = value
+        else:
+            model[name] = value
+    if "tri_none_" not in arrays.files:
+        return model
+    for name in arrays["tri_none_"]:
+        state[str(name)] = None
+    triangulation = Delaunay.__new__(Delaunay)
+    triangulation.__dict__.update(state)
+    model["triangulation"] = (
+        triangulation,
+        arrays["tri_offset_"],
+        arrays["tri_scale_"],
+    )
+    return model
 
-    #  Set default parameters and read from parameters file
 
+# Beam model with key from cache_dir, None if it is not in the cache
+def LoadBeamCache(cache_dir, key):
+    cache_file = os.path.join(os.path.expanduser(cache_dir), key + ".npz")
     try:
-        k_u = PARAMS_JDF.k_u
-    except (NameError, AttributeError) as e:
-        k_u = 228.4727
-    try:
-        a_u = PARAMS_JDF.a_u
-    except (NameError, AttributeError) as e:
-        a_u = 1.0121809
-    try:
-        SlicesMultiplyFactor = PARAMS_JDF.SlicesMultiplyFactor
-    except (NameError, AttributeError) as e:
-        SlicesMultiplyFactor = 10
-    try:
-        Num_Of_Slice_Particles = PARAMS_JDF.NumOfSliceParticles
-    except (NameError, AttributeError) as e:
-        Num_Of_Slice_Particles = 800
-    try:
-        binnumber_X = PARAMS_JDF.X_DensitySampling
-    except (NameError, AttributeError) as e:
-        binnumber_X = 40
-    try:
-        binnumber_Y = PARAMS_JDF.Y_DensitySampling
-    except (NameError, AttributeError) as e:
-        binnumber_Y = 40
-    try:
-        binnumber_Z = PARAMS_JDF.Z_DensitySampling
-    except (NameError, AttributeError) as e:
-        binnumber_Z = 40
+        with np.load(cache_file) as arrays:
+            model = BeamCacheModel(arrays)
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    # Mark as recently used - another run may have removed the file meanwhile
     try:
-        S_factor = PARAMS_JDF.BeamStretchFactor
-    except (NameError, AttributeError) as e:
-        S_factor = 0.0
-    try:
-        RNG_seed = PARAMS_JDF.RNG_seed
-    except (NameError, AttributeError) as e:
-        RNG_seed = np.random.randint(0, 2 ** 32)
-    try:
-        out_file = str(PARAMS_JDF.out_file)
-    except (NameError, AttributeError) as e:
-        # default name = base name + JDF + seed
-        out_file = file_name_base + "_JDF_" + str(RNG_seed) + ".h5"
-
-    print ("random number generator seed is initialized to", RNG_seed)
-    np.random.seed(RNG_seed)
-    # Print to screen parameters used for calculations.
-    # ==============================================================================
-    print "User defined parameters:"
-    print "k_u = ", k_u
-    print "a_u = ", a_u
-    print "Slices per wavelnegth = ", SlicesMultiplyFactor
-    # print 'Particle density samples = ',binnumber
-    print "Density sampling in X = ", binnumber_X
-    print "Density sampling in Y = ", binnumber_Y
-    print "Current / Density sampling in Z =", binnumber_Z
-    print "Stretching factor in Z = ", S_factor
-    # print 'Shape sampling number = ',NumShapeSlices
-    # ==============================================================================
-
-    f = tables.open_file(file_name_in, "r")
-    Particles = f.root.Particles.read()
+        os.utime(cache_file, None)
+    except OSError:
+        pass
+    return model
+
+
+# Store the beam model under key in cache_dir and remove the least recently
+# used files until the cache is not larger than max_size MB
+def SaveBeamCache(cache_dir, key, model, max_size=2000):
+    cache_dir = os.path.expanduser(cache_dir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    cache_file = os.path.join(cache_dir, key + ".npz")
+    # Written under a temporary name first, so that concurrent runs never read
+    # a partial file
+    temp_file = cache_file + ".%d.tmp" % os.getpid()
+    with open(temp_file, "wb") as f:
+        np.savez(f, **BeamCacheArrays(model))
+    os.replace(temp_file, cache_file)
+    files = [
+        os.path.join(cache_dir, name)
+        for name in os.listdir(cache_dir)
+        if name.endswith(".npz")
+    ]
+    # Runs sharing the cache directory may remove the same files concurrently
+    sizes = {}
+    for name in files:
+        try:
+            sizes[name] = (os.path.getmtime(name), os.path.getsize(name))
+        except OSError:
+            pass
+    files = sorted(sizes, key=lambda name: sizes[name][0])
+    size = sum(sizes[name][1] for name in files)
+    while files and size > max_size * 1024.0**2:
+        name = files.pop(0)
+        if name == cache_file:
+            continue
+        size -= sizes[name][1]
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+
+
+# Parameters which may differ between the runs of a sweep (see run_jdf_sweep) -
+# the other parameters and everything derived from the input beam are shared
+SWEEP_PARAMETERS = (
+    "RNG_seed",
+    "NumOfSliceParticles",
+    "SlicesMultiplyFactor",
+    "out_file",
+)
+
+
+# Read the input beam and compute everything which does not depend on the
+# SWEEP_PARAMETERS and can be stored in the beam cache: statistics, smoothed
+# current profile and 3D density map and the input points of the momentum
+# mapping. Stage times are added to times. Returns a dict of arrays and numbers.
+def ReadBeamModel(file_name_in, P, times):
+    import scipy.ndimage as ndimage
+
+    k_u = P["k_u"]
+    a_u = P["a_u"]
+    binnumber_X = P["X_DensitySampling"]
+    binnumber_Y = P["Y_DensitySampling"]
+    binnumber_Z = P["Z_DensitySampling"]
+    S_factor = P["BeamStretchFactor"]
+    InputChunkSize = P["InputChunkSize"]
+    MomentumSampleSize = P["MomentumSampleSize"]
+    histogramming = StageTimer(times, "histogramming")
+
+    # The input is processed in chunks of InputChunkSize rows - statistics and
+    # histograms are accumulated chunk by chunk, the particle set is never held whole
+    f = ParticleFile(file_name_in, P["InputReader"])
+    Particles = f.Particles
 
     # Filter the particles with z values
 
-    # *************************************************************
-    # The below section calculates size of the bin according
-    # to value of Lc (binnumbers=total_length/Lc)
-    # USER DATA - MODIFY ACCORDING TO REQUIREMENTS
-    Pi = np.pi  # Pi number taken from 'numpy' as more precise than just 3.1415
-    c = 299792458.0  # Speed of light
-    m = 9.11e-31  # mass of electron
-    e_0 = 8.854e-12  # vacuum permitivity
-    e_ch = 1.602e-19  # charge of one electron
-
-    # *************************************************************
-    JDFSmoothing = 1.0
-
     # Select slice from the beam
     # print len(Particles)
     # midZ=np.mean(Particles[:,4])
@@ -312,136 +1684,322 @@ if __name__ == "__main__":
     # Particles=Particles[(Particles[:,4] < (midZ+zlen)) & (Particles[:,4] > (midZ-zlen))]
     # print len(Particles)
 
-    mA_X = Particles[:, 0]
-    mA_Y = Particles[:, 2]
-    mA_Z = Particles[:, 4]
-    # Descale the momentum units from p/mc to SI - to keep compatibility with rest of calculations
-    mA_PX = Particles[:, 1] * (m * c)
-    mA_PY = Particles[:, 3] * (m * c)
-    mA_PZ = Particles[:, 5] * (m * c)
-    mA_WGHT = Particles[:, 6]
-
     # The below section calculate some initial data - 4*Pi*Rho is the one mose desired
-    xyz = np.vstack([mA_X, mA_Y, mA_Z]).T
-    size_x = max(mA_X) - min(mA_X)
-    size_y = max(mA_Y) - min(mA_Y)
-    size_z = max(mA_Z) - min(mA_Z)
-    minx = np.min(mA_X)
-    maxx = np.max(mA_X)
-    miny = np.min(mA_Y)
-    maxy = np.max(mA_Y)
-    print "Size of sample X,Y,Z = ", size_x, size_y, size_z
+    with histogramming:
+        Stats = ScanParticles(Particles, InputChunkSize)
+    minx, miny, minz = Stats["min"][[0, 2, 4]]
+    maxx, maxy, maxz = Stats["max"][[0, 2, 4]]
+    size_x = maxx - minx
+    size_y = maxy - miny
+    size_z = maxz - minz
+    print("Size of sample X,Y,Z = ", size_x, size_y, size_z)
 
     # Calculate some needed values: Omega,Rho,Lc,Lambda_U,Lambda_R,
-    p_tot = np.sqrt((mA_PX[:] ** 2) + (mA_PY[:] ** 2.0) + (mA_PZ[:] ** 2.0))
-    gamma = np.sqrt(1 + (p_tot / (m * c)) ** 2.0)
-    gamma_0 = np.mean(gamma)
-    RandomHaltonSequence = HaltonRandomNumber(2, Num_Of_Slice_Particles)
-    z_hlt = 0.5 - HaltonRandomNumber(2, Num_Of_Slice_Particles)
+    gamma_0 = Stats["gamma_0"]
     # RandomHaltonSequence=np.random.rand(Num_Of_Slice_Particles,2)
     ## Linear smoothing between bins in JDF_CORE
 
     lambda_u = (2.0 * Pi) / k_u
     # Use plane-pole undulator
-    lambda_r = (lambda_u / (2.0 * gamma_0 ** 2.0)) * (1 + (a_u ** 2.0) / 2.0)
-    print "Using plane-pole undulator configuration !"
+    lambda_r = (lambda_u / (2.0 * gamma_0**2.0)) * (1 + (a_u**2.0) / 2.0)
+    print("Using plane-pole undulator configuration !")
 
     # Use helical undulator
     # lambda_r=(lambda_u/(2*gamma_0**2))*(1+a_u**2)
     # print 'Using helical undulator configuration !'
-    print "lambda_r = ", lambda_r
-
-    NumberOfSlices = int(
-        SlicesMultiplyFactor
-        * ((max(mA_Z) + S_factor * size_z) - (min(mA_Z) - S_factor * size_z))
-        / (lambda_r)
-    )
-    TotalNumberOfElectrons = np.sum(mA_WGHT)
-    InitialParticleCharge = TotalNumberOfElectrons * e_ch
-
-    Hz, edges_Z = np.histogram(
-        mA_Z,
-        bins=binnumber_Z,
-        normed=False,
-        weights=mA_WGHT,
-        range=((min(mA_Z) - S_factor * size_z, max(mA_Z) + S_factor * size_z)),
-    )
-    Hz = ndimage.gaussian_filter(Hz, 1.0)
-    Non_Zero_Z = float(np.count_nonzero(Hz))
-    # x0_Z = np.linspace(0.5*(edges_Z[0][0]+edges_Z[0][1]),0.5*(edges_Z[0][binnumber_Z]+edges_Z[0][binnumber_Z-1]),binnumber_Z)
-    x0_Z = np.linspace(
-        0.5 * (edges_Z[0] + edges_Z[1]),
-        0.5 * (edges_Z[binnumber_Z] + edges_Z[binnumber_Z - 1]),
-        binnumber_Z,
-    )
-    y0_Z = Hz
-
-    f_Z = interpolate.PchipInterpolator(x0_Z, y0_Z)
-    m_Z_plt = np.linspace(
-        min(mA_Z) - S_factor * size_z, max(mA_Z) + S_factor * size_z, 100
-    )
-    plt.plot(m_Z_plt, f_Z(m_Z_plt))
-    plt.show()
-
-    start = time.time()
-    x0y0z0 = np.vstack((mA_X, mA_Y, mA_Z)).T
-
-    # Create 3D particles density map
-    HxHyHz, edges_XYZ = np.histogramdd(
-        x0y0z0, bins=(binnumber_X, binnumber_Y, binnumber_Z), weights=mA_WGHT
-    )
-    print "Histogram done..."
-    # Apply Gaussian filter to smoothen density map artifacts (1.0 is default value)
-    # if user wish to use 'raw' data the below line should be commented
-    HxHyHz = ndimage.gaussian_filter(HxHyHz, 1.0)
-
-    # Map the 3D density map onto equispaced meshgrid
-    new_x = np.linspace(np.min(mA_X), np.max(mA_X), binnumber_X)
-    new_y = np.linspace(np.min(mA_Y), np.max(mA_Y), binnumber_Y)
-    new_z = np.linspace(np.min(mA_Z), np.max(mA_Z), binnumber_Z)
-
-    xxh, yyh, zzh = np.meshgrid(new_x, new_y, new_z)
-    positions = np.column_stack(
-        (xxh.ravel("F"), yyh.ravel("F"), zzh.ravel("F"), HxHyHz.ravel("F"))
-    )
-    ## The below line removes or histogram values < 0 what improves performance
-    positions = positions[positions[:, 3] > 0.0]
-    xyzpoints = np.vstack((positions[:, 0], positions[:, 1], positions[:, 2])).T
-
-    # Interpolate the 3D histogram (meshgrid) into continuous distribution (nearest neighbor or linear interpolation allowed)
-    ### Linear interpolation - slow but more accurate
-    # interpolator=interpolate.LinearNDInterpolator(xyzpoints,positions[:,3],rescale=True,fill_value=0)
-
-    ### Nearest neighbour interpolation - fast and less accurate
-
-    interpolator = interpolate.NearestNDInterpolator(
-        xyzpoints, positions[:, 3], rescale=True
-    )
+    print("lambda_r = ", lambda_r)
+
+    TotalNumberOfElectrons = Stats["total_weight"]
+
+    # Nodes of the 3D density map - with DensityCrop cut in X and Y to the range
+    # which holds the bulk of the charge, at the same grid step
+    new_x = np.linspace(minx, maxx, binnumber_X)
+    new_y = np.linspace(miny, maxy, binnumber_Y)
+    new_z = np.linspace(minz, maxz, binnumber_Z)
+    if P["DensityCrop"]:
+        with histogramming:
+            new_x, new_y = CropNodes(
+                Particles, (0, 2), (new_x, new_y), P["DensityCrop"], InputChunkSize
+            )
+        print("Density grid cropped to X, Y = ", len(new_x), len(new_y))
+
+    # Current histogram and 3D particles density map in one pass over the input
+    range_z = (minz - S_factor * size_z, maxz + S_factor * size_z)
+    with histogramming:
+        if P["DensityEstimator"] == "kde":
+            Hz, edges_Z, HxHyHz, moments = LinearBinParticles(
+                Particles, binnumber_Z, range_z, (new_x, new_y, new_z), InputChunkSize
+            )
+        else:
+            Hz, edges_Z, HxHyHz, edges_XYZ = HistogramParticles(
+                Particles,
+                binnumber_Z,
+                range_z,
+                (len(new_x), len(new_y), binnumber_Z),
+                ((new_x[0], new_x[-1]), (new_y[0], new_y[-1]), (minz, maxz)),
+                InputChunkSize,
+            )
+    print("Histogram done...")
+    with StageTimer(times, "interpolator build"):
+        Hz = ndimage.gaussian_filter(Hz, 1.0)
+        Non_Zero_Z = float(np.count_nonzero(Hz))
+        # x0_Z = np.linspace(0.5*(edges_Z[0][0]+edges_Z[0][1]),0.5*(edges_Z[0][binnumber_Z]+edges_Z[0][binnumber_Z-1]),binnumber_Z)
+        x0_Z = np.linspace(
+            0.5 * (edges_Z[0] + edges_Z[1]),
+            0.5 * (edges_Z[binnumber_Z] + edges_Z[binnumber_Z - 1]),
+            binnumber_Z,
+        )
+        y0_Z = Hz
+
+        if P["DensityEstimator"] == "kde":
+            # Kernel density estimate on the grid nodes, DensityBandwidth (m, one
+            # for all axes or per axis) or by Scott's rule
+            bandwidth = P["DensityBandwidth"]
+            if bandwidth is None:
+                bandwidth = ScottBandwidth(moments["rms"], moments["n_eff"])
+            bandwidth = np.broadcast_to(np.asarray(bandwidth, dtype=float), (3,))
+            print("KDE bandwidth X,Y,Z = ", *bandwidth)
+            steps = [(n[-1] - n[0]) / max(len(n) - 1, 1) for n in (new_x, new_y, new_z)]
+            HxHyHz = KernelDensity(
+                HxHyHz,
+                [h / step if step > 0 else 0.0 for h, step in zip(bandwidth, steps)],
+            )
+        else:
+            # Apply Gaussian filter to smoothen density map artifacts (1.0 is default value)
+            # if user wish to use 'raw' data the below line should be commented
+            HxHyHz = ndimage.gaussian_filter(HxHyHz, 1.0)
+
+        ### Below is option to plot the density map of the beam - uncomment if you want to see one.
+        # ==============================================================================
+        # import matplotlib.pyplot as plt
+        # from mpl_toolkits.mplot3d import Axes3D
+        # xxh, yyh, zzh = np.meshgrid(new_x, new_y, new_z, indexing="ij")
+        # fig = plt.figure()
+        # ax = fig.add_subplot(111, projection='3d')
+        # ax.scatter(xxh.ravel(), yyh.ravel(), zzh.ravel(), c=HxHyHz.ravel())
+        # plt.show()
+        # ==============================================================================
+
+    # Input points of the momentum mapping - MomentumSampleSize limits the number
+    # of input particles used for it
+    stride = 1
+    if MomentumSampleSize:
+        stride = max(int(ceil(Stats["n"] / float(MomentumSampleSize))), 1)
+    with StageTimer(times, "momentum input"):
+        mA_XYZ, mA_PXPYPZ = ReadMomentumPoints(
+            Particles, InputChunkSize, stride, P["WorkingDtype"]
+        )
+    f.close()
+
+    return {
+        "minz": minz,
+        "maxz": maxz,
+        "size_z": size_z,
+        "lambda_r": lambda_r,
+        "TotalNumberOfElectrons": TotalNumberOfElectrons,
+        "Non_Zero_Z": Non_Zero_Z,
+        "x0_Z": x0_Z,
+        "y0_Z": y0_Z,
+        "HxHyHz": HxHyHz,
+        "new_x": new_x,
+        "new_y": new_y,
+        "new_z": new_z,
+        "mA_XYZ": mA_XYZ,
+        "mA_PXPYPZ": mA_PXPYPZ,
+    }
+
+
+# Prepare everything which does not depend on the SWEEP_PARAMETERS - the beam
+# model (ReadBeamModel) with the triangulation of the momentum mapping, taken
+# from the beam cache in CacheDir if it is there, the current profile f_Z and
+# the density interpolator. P are the parameters (see ReadParameters).
+# Returns a dict with the beam data used by PlanRun and WriteRun.
+def PrepareBeam(file_name_in, P, plot_file=None):
+    from scipy import interpolate
+
+    binnumber_X = P["X_DensitySampling"]
+    binnumber_Y = P["Y_DensitySampling"]
+    S_factor = P["BeamStretchFactor"]
+    DensityInterpolation = P["DensityInterpolation"]
+    JDFSmoothing = 1.0
+    if P["MomentumEngine"] not in ("delaunay", "windowed"):
+        raise ValueError("Unknown MomentumEngine: " + str(P["MomentumEngine"]))
+    if P["SamplingMode"] not in ("slices", "joint"):
+        raise ValueError("Unknown SamplingMode: " + str(P["SamplingMode"]))
+    if P["DensityEstimator"] not in ("histogram", "kde"):
+        raise ValueError("Unknown DensityEstimator: " + str(P["DensityEstimator"]))
 
-    ### Below is option to plot the density map of the beam - uncomment if you want to see one.
+    # Print to screen parameters used for calculations.
     # ==============================================================================
-    # from mpl_toolkits.mplot3d import Axes3D
-    # fig = plt.figure()
-    # ax = fig.add_subplot(111, projection='3d')
-    # ax.scatter(xyzpoints[:,0],xyzpoints[:,1],xyzpoints[:,2],c=positions[:,3])
-    # plt.show()
+    print("User defined parameters:")
+    print("k_u = ", P["k_u"])
+    print("a_u = ", P["a_u"])
+    # print 'Particle density samples = ',binnumber
+    print("Density sampling in X = ", binnumber_X)
+    print("Density sampling in Y = ", binnumber_Y)
+    print("Current / Density sampling in Z =", P["Z_DensitySampling"])
+    print("Stretching factor in Z = ", S_factor)
+    print("Density interpolation = ", DensityInterpolation)
+    print("Density estimator = ", P["DensityEstimator"])
+    print("Sampling mode = ", P["SamplingMode"])
+    print("Momentum interpolation = ", P["MomentumEngine"])
+    # print 'Shape sampling number = ',NumShapeSlices
     # ==============================================================================
 
-    print "Interpolation map created..."
-
-    minz = np.min(x0y0z0[:, 2])
-    maxz = np.max(x0y0z0[:, 2])
-
+    # Wall time of the stages (see StageTimer)
+    times = {}
+    model = None
+    if P["CacheDir"]:
+        with StageTimer(times, "beam cache"):
+            key = BeamCacheKey(file_name_in, P)
+            model = LoadBeamCache(P["CacheDir"], key)
+        if model is not None:
+            print("Beam model loaded from cache", key)
+    if model is None:
+        model = ReadBeamModel(file_name_in, P, times)
+        # Delaunay triangulation of the input particles for the momentum mapping -
+        # or just the input particles sorted by z for the windowed engine
+        with StageTimer(times, "triangulation"):
+            if P["MomentumEngine"] == "windowed":
+                order = np.argsort(model["mA_XYZ"][:, 2], kind="stable")
+                model["mA_XYZ"] = model["mA_XYZ"][order]
+                model["mA_PXPYPZ"] = model["mA_PXPYPZ"][order]
+            else:
+                model["triangulation"] = MomentumTriangulation(model.pop("mA_XYZ"))
+        if P["CacheDir"]:
+            with StageTimer(times, "beam cache"):
+                SaveBeamCache(P["CacheDir"], key, model, P["CacheSize"])
+
+    minz = model["minz"]
+    maxz = model["maxz"]
+    size_z = model["size_z"]
+    with StageTimer(times, "interpolator build"):
+        f_Z = interpolate.PchipInterpolator(model["x0_Z"], model["y0_Z"])
+
+        # Keep the 3D histogram on its regular grid - slices are read from it directly
+        # ("nearest" - nearest grid plane in z, "linear" - trilinear interpolation)
+        interpolator = RegularGridDensity(
+            model["HxHyHz"],
+            model["new_x"],
+            model["new_y"],
+            model["new_z"],
+            mode=DensityInterpolation,
+        )
+        # Cumulative tables of the joint sampler
+        sampler = None
+        if P["SamplingMode"] == "joint":
+            sampler = JointDensitySampler(
+                model["HxHyHz"],
+                model["new_x"],
+                model["new_y"],
+                model["new_z"],
+                mode=DensityInterpolation,
+            )
+    print("Interpolation map created...")
+    if plot_file:
+        m_Z_plt = np.linspace(minz - S_factor * size_z, maxz + S_factor * size_z, 100)
+        PlotCurrentProfile(f_Z, m_Z_plt, plot_file)
+
+    return {
+        "file_name_in": file_name_in,
+        "minz": minz,
+        "maxz": maxz,
+        "size_z": size_z,
+        "S_factor": S_factor,
+        "lambda_r": model["lambda_r"],
+        "TotalNumberOfElectrons": model["TotalNumberOfElectrons"],
+        "InitialParticleCharge": model["TotalNumberOfElectrons"] * e_ch,
+        "Non_Zero_Z": model["Non_Zero_Z"],
+        "f_Z": f_Z,
+        "interpolator": interpolator,
+        "slice_args": dict(
+            bin_x_in=len(model["new_x"]),
+            bin_y_in=len(model["new_y"]),
+            interpolator=interpolator,
+            f_Z=f_Z,
+            new_x=model["new_x"],
+            new_y=model["new_y"],
+            Non_Zero_Z=model["Non_Zero_Z"],
+            minz=minz,
+            JDFSmoothing=JDFSmoothing,
+        ),
+        "mA_PXPYPZ": model["mA_PXPYPZ"].astype(P["WorkingDtype"], copy=False),
+        "sampler": sampler,
+        "mA_XYZ": model.get("mA_XYZ"),
+        "triangulation": model.get("triangulation"),
+        "stage_times": times,
+    }
+
+
+# Finest resolution of z in the working dtype, relative to the slice length,
+# that PlanRun accepts
+MIN_SLICE_RESOLUTION = 1e-3
+
+
+# Particles per slice following the current of the slices (current - f_Z at the
+# slices): the slice with the highest current gets N particles, the others
+# proportionally fewer, but at least minimum. With a budget (total number of
+# particles) the counts are scaled down - never below minimum - to fit into it
+# (a warning gives the total if minimum for every slice exceeds the budget).
+def SliceParticleCounts(current, N, minimum=1, budget=None):
+    current = np.asarray(current, dtype=float)
+    minimum = max(min(minimum, N), 1)
+
+    def Counts(scale):
+        return np.clip(np.round(scale * current), minimum, N).astype(int)
+
+    scale = N / np.max(current)
+    if budget is not None and np.sum(Counts(scale)) > budget:
+        # Largest scale within the budget (the counts grow with the scale)
+        low, high = 0.0, scale
+        for step in range(64):
+            middle = 0.5 * (low + high)
+            if np.sum(Counts(middle)) > budget:
+                high = middle
+            else:
+                low = middle
+        scale = low
+        if np.sum(Counts(scale)) > budget:
+            print(
+                "Warning: particle budget of %d is below %d particles for each of the"
+                " %d slices - %d new particles are used"
+                % (budget, minimum, len(current), np.sum(Counts(scale)))
+            )
+    return [int(count) for count in Counts(scale)]
+
+
+# Slices of one run - adds NumberOfSlices, StepZ, slice_list and slice_counts
+# (particles of every slice - NumOfSliceParticles, or following the current with
+# AdaptiveSliceParticles) to run (a dict with the SWEEP_PARAMETERS), returns it.
+# With the joint SamplingMode slice_list and slice_counts are the blocks of the
+# joint sampler and joint is added (see JointBlockCalculate).
+def PlanRun(Beam, run, P):
+    minz = Beam["minz"]
+    maxz = Beam["maxz"]
+    S_factor = Beam["S_factor"]
+    size_z = Beam["size_z"]
+    f_Z = Beam["f_Z"]
+    Non_Zero_Z = Beam["Non_Zero_Z"]
+    Num_Of_Slice_Particles = run["NumOfSliceParticles"]
+    NumberOfSlices = int(
+        run["SlicesMultiplyFactor"]
+        * ((maxz + S_factor * size_z) - (minz - S_factor * size_z))
+        / (Beam["lambda_r"])
+    )
     StepZ = (maxz - minz) / NumberOfSlices
+    # The new particles keep z in the working dtype - its resolution at the
+    # largest |z| has to be well below the slice length
+    resolution = np.spacing(np.dtype(P["WorkingDtype"]).type(max(abs(minz), abs(maxz))))
+    if resolution > MIN_SLICE_RESOLUTION * StepZ:
+        raise ValueError(
+            "WorkingDtype %s resolves z only to %g at |z| = %g, slice length is %g"
+            " - use float64 or shift the beam to z = 0"
+            % (P["WorkingDtype"], resolution, max(abs(minz), abs(maxz)), StepZ)
+        )
 
-    # Sweep over all slices along Z-axis (longitudinal direction) and generate new microparticles
-    # Routine is parallel and uses ALL available cores
-    pool = multiprocessing.Pool()
-    print "Executing main JDF loop..."
-    result2 = []
     # Create list of slices to calculate - with positive value of current, avoids further checks in algorithm.
     slice_list = []
-    # parallel routine
+    slice_current = []
     for slice_number in range(0, NumberOfSlices):
         ZZZ = minz + (slice_number * StepZ)
         NoOfElec = (
@@ -449,166 +2007,1000 @@ if __name__ == "__main__":
         )
         if NoOfElec > 0:
             slice_list.append(slice_number)
-
-    for slice_number in slice_list:
-        pool.apply_async(
-            SliceCalculate,
-            args=(
-                binnumber_X,
-                binnumber_Y,
-                z_hlt[:, 1],
-                slice_number,
-                StepZ,
-                NumberOfSlices,
-                interpolator,
-                f_Z,
-                new_x,
-                new_y,
-                Non_Zero_Z,
-                Num_Of_Slice_Particles,
-                minz,
-                JDFSmoothing,
-                RandomHaltonSequence,
+            slice_current.append(f_Z(ZZZ))
+    if P["AdaptiveSliceParticles"] and slice_list:
+        slice_counts = SliceParticleCounts(
+            slice_current,
+            Num_Of_Slice_Particles,
+            P["SliceParticlesMin"],
+            P["ParticleBudget"],
+        )
+    else:
+        slice_counts = [Num_Of_Slice_Particles] * len(slice_list)
+    if P["SamplingMode"] == "joint":
+        # The same number of particles from the joint sampler, with equal weights -
+        # its blocks take the place of the slices
+        n = sum(slice_counts)
+        slice_counts = [
+            min(JointBlockSize, n - first) for first in range(0, n, JointBlockSize)
+        ]
+        slice_list = list(range(len(slice_counts)))
+        run["joint"] = {
+            "n": n,
+            "weight": Beam["TotalNumberOfElectrons"] / max(n, 1),
+            "slice_z": (minz, StepZ) if P["JointSliceZ"] else None,
+        }
+    run["NumberOfSlices"] = NumberOfSlices
+    run["StepZ"] = StepZ
+    run["slice_list"] = slice_list
+    run["slice_counts"] = slice_counts
+    return run
+
+
+# Sharded runs - shard index of count computes the index-th of count contiguous
+# parts of the slice_list of a run and writes it to its own file (see
+# ShardFileName) without rescaling the charge. MergeShards combines the shard
+# files of a run into its output file. The shards are independent processes -
+# started by MPI (see MPIShard) or as the tasks of a job array.
+
+
+# Name of the shard file of shard index of count for the output file out_file
+def ShardFileName(out_file, index, count):
+    return os.path.splitext(out_file)[0] + "_shard%dof%d.h5" % (index, count)
+
+
+# Restrict run (see PlanRun) to shard index of count
+def ShardRun(run, index, count):
+    # Parts with about the same number of particles
+    first, last = BalancedRanges(run["slice_counts"], count)[index]
+    run["slice_list"] = run["slice_list"][first:last]
+    run["slice_counts"] = run["slice_counts"][first:last]
+    run["shard"] = (index, count)
+    run["merged_file"] = run["out_file"]
+    run["out_file"] = ShardFileName(run["out_file"], index, count)
+    return run
+
+
+# Shard of this process when started by MPI (mpirun -n count ... --mpi) - returns
+# (index, count, communicator), raises ImportError if mpi4py is not installed
+def MPIShard():
+    from mpi4py import MPI
+
+    comm = MPI.COMM_WORLD
+    return comm.Get_rank(), comm.Get_size(), comm
+
+
+# Merge the count shard files of out_file (all shards must be done) into
+# out_file - particles are copied in shard order with the weights scaled to the
+# total charge of the input beam (the global ChargeFactor, returned). Particles
+# with weights <= 0 (after the Poisson noise) or NaN values are dropped. remove
+# deletes the shard files afterwards.
+def MergeShards(out_file, count, complevel=1, remove=False, chunk_rows=1000000):
+    import tables
+
+    shard_files = [ShardFileName(out_file, index, count) for index in range(count)]
+    shard_weight = 0.0
+    rows = 0
+    for index, shard_file in enumerate(shard_files):
+        f = tables.open_file(shard_file, "r")
+        attrs = f.root.Particles._v_attrs
+        if (attrs.JDFShardIndex, attrs.JDFShardCount) != (index, count):
+            f.close()
+            raise ValueError(shard_file + " is not shard %d of %d" % (index, count))
+        if index == 0:
+            TotalNumberOfElectrons = attrs.JDFTotalNumberOfElectrons
+            source_file = attrs.FXFELSourceFileName
+        shard_weight += attrs.JDFShardWeight
+        rows += f.root.Particles.nrows
+        f.close()
+    ChargeFactor = 1.0
+    if shard_weight > 0:
+        ChargeFactor = TotalNumberOfElectrons / shard_weight
+
+    writer = OpenParticleWriter(
+        out_file, source_file, expectedrows=rows, complevel=complevel
+    )
+    for shard_file in shard_files:
+        f = tables.open_file(shard_file, "r")
+        for first, chunk in IterParticleChunks(f.root.Particles, chunk_rows):
+            chunk[:, 6] = chunk[:, 6] * ChargeFactor
+            writer.append(chunk)
+        f.close()
+    writer.close()
+    if remove:
+        for shard_file in shard_files:
+            os.remove(shard_file)
+    print("Merged", count, "shards into", out_file)
+    print("Charge scaling factor = ", ChargeFactor)
+    print("Final charge of particles = ", writer.total_weight * e_ch)
+    return ChargeFactor
+
+
+# Checkpoints - with CheckpointInterval set, the slices computed so far and the
+# progress of the momentum mapping of a run are saved to a sidecar file (see
+# CheckpointFileName) at most every CheckpointInterval seconds. With Resume a run
+# continues from its checkpoint: only the missing slices are computed (their
+# noise streams do not depend on the other slices, see SliceNoise) and the
+# output file is continued behind the last saved row, so the final output is the
+# same as without the interruption. The checkpoint is removed when the run is
+# done.
+
+
+# Name of the checkpoint file of the output file out_file
+def CheckpointFileName(out_file):
+    return os.path.splitext(out_file)[0] + "_checkpoint.h5"
+
+
+# Key of a run (see PlanRun) - a checkpoint is only used for the run it was
+# written by, with the same input file and parameters
+def CheckpointKey(Beam, run, P):
+    import hashlib
+
+    file_name_in = Beam["file_name_in"]
+    digest = hashlib.sha256()
+    digest.update(
+        repr(
+            (
+                os.path.abspath(file_name_in),
+                os.path.getsize(file_name_in),
+                os.path.getmtime(file_name_in),
+                [P[name] for name in BEAM_CACHE_PARAMETERS],
+                P["DensityInterpolation"],
+                P["WorkingDtype"],
+                P["SamplingMode"],
+                P["JointSliceZ"],
+                int(run["RNG_seed"]),
+                run["NumberOfSlices"],
+                run["StepZ"],
+                list(run["slice_list"]),
+                list(run["slice_counts"]),
+            )
+        ).encode()
+    )
+    return digest.hexdigest()
+
+
+# Checkpoint of one run - the rows of the slices done so far are stored in
+# /Rows in the order they were saved, with their row ranges in the run in
+# /Ranges. The attributes MappedRows, OutputRows and OutputWeight record the
+# progress of the momentum mapping: rows mapped and the rows and sum of weights
+# of the output file. interval None only reads an existing checkpoint.
+class RunCheckpoint(object):
+    def __init__(self, out_file, key, dtype, interval=None, resume=False):
+        import tables
+
+        self.file_name = CheckpointFileName(out_file)
+        self.interval = interval
+        self.last = time.time()
+        self.pending = []
+        self.file = None
+        if resume and os.path.exists(self.file_name):
+            self.file = tables.open_file(self.file_name, "a")
+            if self.file.root._v_attrs.JDFCheckpointKey != key:
+                self.file.close()
+                raise ValueError(
+                    self.file_name + " belongs to a different run - remove it to "
+                    "start the run from the beginning"
+                )
+            print("Resuming from checkpoint", self.file_name)
+        elif interval is not None:
+            self.file = tables.open_file(self.file_name, "w")
+            self.file.create_earray(
+                "/", "Rows", tables.Atom.from_dtype(np.dtype(dtype)), (0, 4)
+            )
+            self.file.create_earray("/", "Ranges", tables.Int64Atom(), (0, 2))
+            attrs = self.file.root._v_attrs
+            attrs.JDFCheckpointKey = key
+            attrs.MappedRows = 0
+            attrs.OutputRows = 0
+            attrs.OutputWeight = 0.0
+            self.file.flush()
+
+    # Copy the saved slices into rows (the particles of the run) and return
+    # a mask of the slices (with counts particles each) which are done
+    def restore(self, rows, counts):
+        ends = np.cumsum(counts)
+        done = np.zeros(len(counts), dtype=bool)
+        if self.file is None:
+            return done
+        position = 0
+        for first, last in self.file.root.Ranges[:]:
+            rows[first:last] = self.file.root.Rows[position : position + last - first]
+            position += last - first
+            # Tasks cover whole slices
+            start, end = np.searchsorted(ends, [first, last], "right")
+            done[start:end] = True
+        return done
+
+    def due(self):
+        return self.interval is not None and time.time() - self.last >= self.interval
+
+    # Rows first to last of rows (the particles of the run) are done - they are
+    # saved with the next checkpoint
+    def slices_done(self, rows, first, last):
+        self.pending.append((first, last))
+        if self.due():
+            self.save_slices(rows)
+
+    # Save the slices done since the last checkpoint
+    def save_slices(self, rows):
+        if self.interval is None:
+            return
+        for first, last in self.pending:
+            self.file.root.Rows.append(rows[first:last])
+            self.file.root.Ranges.append(np.array([[first, last]]))
+        self.pending = []
+        self.file.flush()
+        self.last = time.time()
+
+    # Rows mapped so far, written to writer (see ParticleWriter) - saved when the
+    # next checkpoint is due
+    def momentum_done(self, mapped, writer):
+        if not self.due():
+            return
+        writer.flush()
+        attrs = self.file.root._v_attrs
+        attrs.MappedRows = mapped
+        attrs.OutputRows = writer.nrows
+        attrs.OutputWeight = writer.total_weight
+        self.file.flush()
+        self.last = time.time()
+
+    # Forget the progress of the momentum mapping - the output file is about to
+    # be changed in place
+    def momentum_reset(self):
+        if self.file is not None:
+            self.file.root._v_attrs.MappedRows = 0
+            self.file.flush()
+
+    # (rows mapped, (rows, sum of weights) of the output file) of the checkpoint
+    def momentum_state(self):
+        if self.file is None:
+            return 0, None
+        attrs = self.file.root._v_attrs
+        if attrs.MappedRows == 0:
+            return 0, None
+        return int(attrs.MappedRows), (int(attrs.OutputRows), float(attrs.OutputWeight))
+
+    # Close the checkpoint file, remove it with remove (the run is done)
+    def close(self, remove=False):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if remove and os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+
+# Add the momenta to the slices of run (computed into buffer, with their noise)
+# and write them to run["out_file"]. Momenta are interpolated by the workers of
+# momentum_pool (see StartMomentumPool), the wall times of the stages are added
+# to times. The progress is saved to checkpoint (see RunCheckpoint) if given.
+# Returns a dict with a summary of the run.
+def WriteRun(Beam, run, buffer, momentum_pool, P, times, checkpoint=None):
+    assembly = StageTimer(times, "assembly")
+    writing = StageTimer(times, "writing")
+    RNG_seed = run["RNG_seed"]
+    index, count = run.get("shard", (0, 1))
+    print("random number generator seed is initialized to", RNG_seed)
+    if count > 1:
+        print("Shard", index, "of", count)
+
+    # The buffer holds the slices one after another - the full particle set is
+    # just a (particles x 4) view of it
+    result_shape = (sum(run["slice_counts"]), 4)
+    print("Output array shape is: ", result_shape)
+    with assembly:
+        Full = np.ctypeslib.as_array(buffer)[: int(np.prod(result_shape))]
+        Full = Full.reshape(-1, 4)
+        Total_Number_Of_Particles = len(Full)
+        print("Total number of particles = ", Total_Number_Of_Particles)
+        Full_X = Full[:, 0]
+        Full_Y = Full[:, 1]
+        Full_Z = Full[:, 2]
+        Full_Ne = Full[:, 3]
+        # The noise was added by the slice workers (see SliceNoise) and the
+        # positions are the first three columns - no copy needed
+        query = Full[:, :3]
+    # Interpolate momentum data onto new microparticles (griddata used)
+    print("Starting to interpolate momentum data... - takes time")
+
+    # Every interpolated chunk is appended to the output file while the next
+    # chunks are computed - a resumed run continues the output file of its
+    # checkpoint behind the rows mapped before
+    print("Saving the output to files...")
+    mapped, resume = 0, None
+    if checkpoint is not None and os.path.exists(run["out_file"]):
+        mapped, resume = checkpoint.momentum_state()
+        if mapped:
+            print("Momenta of", mapped, "particles restored")
+    with writing:
+        writer = OpenParticleWriter(
+            run["out_file"],
+            Beam["file_name_in"],
+            expectedrows=Total_Number_Of_Particles,
+            complevel=P["OutputCompression"],
+            resume=resume,
+        )
+    try:
+        for first, last, Full_P in TimedIter(
+            IterMomentumMapping(
+                query[mapped:], momentum_pool, chunk_rows=P["MomentumChunkSize"]
             ),
-            callback=result2.append,
+            times,
+            "momentum mapping",
+        ):
+            first += mapped
+            last += mapped
+            with writing:
+                # Merge all data into one array
+                x_px_y_py_z_pz_NE = np.column_stack(
+                    (
+                        Full_X[first:last],
+                        Full_P[:, 0],
+                        Full_Y[first:last],
+                        Full_P[:, 1],
+                        Full_Z[first:last],
+                        Full_P[:, 2],
+                        Full_Ne[first:last],
+                    )
+                )
+                writer.append(x_px_y_py_z_pz_NE)
+                if checkpoint is not None:
+                    checkpoint.momentum_done(last, writer)
+    except BaseException:
+        # Closed without rescaling, so that the output file can be opened again
+        # (by a retry, or by a resume from the checkpoint)
+        writer.close()
+        raise
+
+    # Rescale the charge of new particle set (needed due to S_factor usage) -
+    # shards store what is needed to do it when they are merged
+    if checkpoint is not None:
+        checkpoint.momentum_reset()
+    with writing:
+        if "shard" in run:
+            attrs = writer.ParticleGroup._v_attrs
+            attrs.JDFShardIndex = index
+            attrs.JDFShardCount = count
+            attrs.JDFShardWeight = writer.total_weight
+            attrs.JDFTotalNumberOfElectrons = Beam["TotalNumberOfElectrons"]
+            ChargeFactor = writer.close()
+        else:
+            ChargeFactor = writer.close(Beam["TotalNumberOfElectrons"])
+    print("Charge scaling factor = ", ChargeFactor)
+    print("Final charge of particles = ", writer.total_weight * e_ch)
+    return {
+        "out_file": run["out_file"],
+        "RNG_seed": RNG_seed,
+        "NumberOfSlices": run["NumberOfSlices"],
+        "Total_Number_Of_Particles": Total_Number_Of_Particles,
+        "ChargeFactor": ChargeFactor,
+        "merged_file": run.get("merged_file"),
+        "stage_times": times,
+    }
+
+
+# Complete the runs of a sweep - missing SWEEP_PARAMETERS are taken from P, a
+# missing seed is drawn at random. The default output name is the input name +
+# "_JDF_" + seed (+ the values of NumOfSliceParticles / SlicesMultiplyFactor if
+# they differ between the runs) + ".h5"; out_file of P is used for single runs.
+def SweepRuns(file_name_in, P, runs):
+    file_name_base = (".".join(file_name_in.split(".")[:-1])).strip()
+    runs = [dict(run) for run in runs]
+    for run in runs:
+        for name in run:
+            if name not in SWEEP_PARAMETERS:
+                raise ValueError(
+                    "Parameter " + name + " can not be changed between the runs"
+                )
+    varying = [
+        name
+        for name in ("NumOfSliceParticles", "SlicesMultiplyFactor")
+        if len(set(run.get(name, P[name]) for run in runs)) > 1
+    ]
+    out_files = set()
+    for run in runs:
+        if len(runs) > 1:
+            run.setdefault("out_file", None)
+        for name in SWEEP_PARAMETERS:
+            run.setdefault(name, P[name])
+        if run["RNG_seed"] is None:
+            run["RNG_seed"] = np.random.randint(0, 2**32)
+        if run["out_file"] is None:
+            # default name = base name + JDF + seed
+            run["out_file"] = (
+                file_name_base
+                + "_JDF_"
+                + str(run["RNG_seed"])
+                + "".join("_" + name + str(run[name]) for name in varying)
+                + ".h5"
+            )
+        run["out_file"] = str(run["out_file"])
+        if run["out_file"] in out_files:
+            raise ValueError("Two runs of the sweep write to " + run["out_file"])
+        out_files.add(run["out_file"])
+    return runs
+
+
+# Memory budget - with MaxMemory (MB) the number of worker processes, the
+# momentum query chunk size and the overlap of the runs of a sweep are chosen so
+# that the estimated memory of all processes stays below it. Estimates in bytes:
+# private memory of a worker process, of the temporary arrays per particle of a
+# slice and density bin (see JDF_CORE_BATCH) and per query point of the momentum
+# mapping, of a momentum worker per simplex of the triangulation (its barycentric
+# transform) and per input point of a window of the windowed engine.
+MEMORY_PROCESS = 30 * 1024**2
+MEMORY_SLICE_BIN = 48
+MEMORY_QUERY_POINT = 160
+MEMORY_SIMPLEX = 96
+MEMORY_WINDOW_POINT = 1200
+# Smallest momentum query chunk
+MEMORY_MIN_CHUNK = 10000
+
+
+# Estimated peak memory (bytes) of a sweep over runs (see PlanRun) with the
+# given numbers of slice and momentum processes, momentum query chunk size and
+# number of output buffers (2 - the next run is computed while the current one
+# is written), without the memory this process uses already.
+def MemoryEstimate(Beam, runs, P, slice_processes, momentum_processes, chunk, buffers):
+    itemsize = np.dtype(P["WorkingDtype"]).itemsize
+    rows = max(sum(run["slice_counts"]) for run in runs)
+    slice_particles = max(max(run["slice_counts"] or [0]) for run in runs)
+    points = len(Beam["mA_PXPYPZ"])
+    if rows <= chunk:
+        # A single chunk is mapped in this process (see StartMomentumPool)
+        momentum_processes = 1
+    # This process - output buffers, the chunks being written and the results
+    # of the momentum workers waiting for it
+    parent = buffers * rows * 4 * itemsize
+    parent += chunk * 7 * 8 * 3 + 2 * momentum_processes * chunk * 3 * 8
+    # Slice workers - Halton sequence and the temporaries of one slice
+    bins = P["X_DensitySampling"] + P["Y_DensitySampling"]
+    slice_worker = MEMORY_PROCESS + slice_particles * (16 + bins * MEMORY_SLICE_BIN)
+    # Momentum workers - their own interpolator and the query chunk
+    momentum_worker = MEMORY_PROCESS + chunk * MEMORY_QUERY_POINT
+    if Beam["triangulation"] is not None:
+        simplices = Beam["triangulation"][0].simplices.shape[0]
+        momentum_worker += simplices * MEMORY_SIMPLEX + points * 3 * 8
+    else:
+        window = min(
+            P["MomentumWindowPoints"] * (1 + 2 * P["MomentumWindowOverlap"]), points
         )
-    pool.close()
-    pool.join()
+        momentum_worker += window * MEMORY_WINDOW_POINT
+    return (
+        parent + slice_processes * slice_worker + momentum_processes * momentum_worker
+    )
 
-    # ==============================================================================
-    # ## SERIAL VERSION DEBUG ONLY !!!
-    #    for slice_number in range(0,NumberOfSlices):
-    #        ZZZ=minz+(slice_number*StepZ)
-    #        NoOfElec=(Non_Zero_Z)*(f_Z(ZZZ)/(NumberOfSlices))/(Num_Of_Slice_Particles)
-    #        if NoOfElec>0:
-    #            results=SliceCalculate(binnumber_X,binnumber_Y,z_hlt[:,1],slice_number,StepZ,NumberOfSlices,interpolator,f_Z,new_x,new_y,Non_Zero_Z,Num_Of_Slice_Particles,minz,JDFSmoothing,RandomHaltonSequence)
-    #            result2.append(results)
-    # ==============================================================================
 
-    # Rearrange the output from parallel loop above
-    print "Output array shape is: ", np.shape(result2)
-    Total_Number_Of_Particles = len(result2) * Num_Of_Slice_Particles
-    print "Total number of particles = ", Total_Number_Of_Particles
-    Full_X = np.zeros(Total_Number_Of_Particles)
-    Full_PX = np.zeros(0)
-    Full_Y = np.zeros(Total_Number_Of_Particles)
-    Full_PY = np.zeros(0)
-    Full_Z = np.zeros(Total_Number_Of_Particles)
-    Full_PZ = np.zeros(0)
-    Full_Ne = np.zeros(Total_Number_Of_Particles)
-    print "Starting rearranging array..."
-    counter = 0
-    for j in range(0, Num_Of_Slice_Particles):
-        for i in range(0, len(result2)):
-            Full_X[counter] = result2[i][j][0]
-            Full_Y[counter] = result2[i][j][1]
-            Full_Z[counter] = result2[i][j][2]
-            Full_Ne[counter] = result2[i][j][3]
-            counter = counter + 1
-    # Generate noise
-    # Add noise
-    print "Adding noise..."
-    Rand_Z = (StepZ * (np.random.random(len(Full_Z)) - 0.50)) / np.sqrt(Full_Ne)
-    Full_Z = Full_Z + Rand_Z
-    # Interpolate momentum data onto new microparticles (griddata used)
-    print "Starting to interpolate momentum data... - takes time"
-
-    def Calculate_PX():
-        Full_PX = interpolate.griddata(
-            (mA_X.ravel(), mA_Y.ravel(), mA_Z.ravel()),
-            mA_PX.ravel(),
-            (Full_X, Full_Y, Full_Z),
-            method="linear",
-            rescale=True,
+# Settings for the runs (see PlanRun) which keep the estimated memory (see
+# MemoryEstimate, plus what this process uses already) below MaxMemory MB. When
+# the budget is tight the momentum query chunks are made smaller first, then
+# the runs of a sweep are no longer overlapped, then the worker pools shrink
+# (down to one process each). Returns a dict with SliceProcesses,
+# MomentumProcesses, MomentumChunkSize, buffers and the estimate in MB.
+def MemoryPlan(Beam, runs, P):
+    budget = P["MaxMemory"] * 1024.0**2
+    base = (PeakRSS()["self"] or 0.0) * 1024.0**2
+    slice_processes = P["SliceProcesses"] or multiprocessing.cpu_count()
+    momentum_processes = P["MomentumProcesses"] or multiprocessing.cpu_count()
+    rows = max(sum(run["slice_counts"]) for run in runs)
+    chunk = min(P["MomentumChunkSize"], max(rows, MEMORY_MIN_CHUNK))
+    buffers = min(len(runs), 2)
+
+    def Estimate():
+        return base + MemoryEstimate(
+            Beam, runs, P, slice_processes, momentum_processes, chunk, buffers
         )
-        return Full_PX
-
-    def Calculate_PY():
-        Full_PY = interpolate.griddata(
-            (mA_X.ravel(), mA_Y.ravel(), mA_Z.ravel()),
-            mA_PY.ravel(),
-            (Full_X, Full_Y, Full_Z),
-            method="linear",
-            rescale=True,
+
+    while Estimate() > budget:
+        if chunk > MEMORY_MIN_CHUNK:
+            chunk = max(chunk // 2, MEMORY_MIN_CHUNK)
+        elif buffers > 1:
+            buffers = 1
+        elif momentum_processes > 1 and momentum_processes >= slice_processes:
+            momentum_processes -= 1
+        elif slice_processes > 1:
+            slice_processes -= 1
+        else:
+            print(
+                "Warning: memory budget of %.0f MB is too small, estimated %.0f MB"
+                % (P["MaxMemory"], Estimate() / 1024.0**2)
+            )
+            break
+    return {
+        "SliceProcesses": slice_processes,
+        "MomentumProcesses": momentum_processes,
+        "MomentumChunkSize": chunk,
+        "buffers": buffers,
+        "estimate_mb": Estimate() / 1024.0**2,
+    }
+
+
+# Parameter sweep / multiple seeds - runs is a list of dicts with values of the
+# SWEEP_PARAMETERS (e.g. [{"RNG_seed": 1}, {"RNG_seed": 2}]), the remaining
+# parameters come from params_module and params (see ReadParameters). The input
+# beam is read and analysed once (PrepareBeam), the pools of worker processes are
+# started once and the slices of the next run are computed while the current one
+# is being written. One output file is written per run (see SweepRuns), with a
+# JSON report of the run next to it (RunReport, see WriteRunReport).
+# plot_file saves the current profile plot, nice lowers the process priority
+# (os.nice), profile_file saves cProfile statistics of this process (not of the
+# worker processes). shard=(index, count) computes only shard index of count of
+# every run (see ShardRun and MergeShards) - the runs need a fixed RNG_seed.
+# Returns a list with a summary dict of every run.
+def run_jdf_sweep(
+    file_name_in,
+    runs,
+    params=None,
+    params_module="PARAMS_JDF",
+    plot_file=None,
+    nice=None,
+    profile_file=None,
+    shard=None,
+):
+    profiler = None
+    if profile_file:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if nice:
+        os.nice(nice)
+    print("Processing file:", file_name_in)
+
+    #  Set default parameters and read from parameters file
+    P = ReadParameters(params, params_module)
+    if shard is not None or P["Resume"]:
+        for run in runs:
+            if run.get("RNG_seed", P["RNG_seed"]) is None:
+                raise ValueError("Sharded and resumed runs need a fixed RNG_seed")
+    runs = SweepRuns(file_name_in, P, runs)
+
+    start = time.time()
+    Beam = PrepareBeam(file_name_in, P, plot_file)
+    for run in runs:
+        PlanRun(Beam, run, P)
+        if shard is not None:
+            ShardRun(run, *shard)
+
+    # Processes, chunk size and buffers within the memory budget
+    memory_plan = None
+    nbuffers = min(len(runs), 2)
+    if P["MaxMemory"]:
+        memory_plan = MemoryPlan(Beam, runs, P)
+        for name in ("SliceProcesses", "MomentumProcesses", "MomentumChunkSize"):
+            P[name] = memory_plan[name]
+        nbuffers = memory_plan["buffers"]
+        print("Memory plan (estimate in MB): ", memory_plan)
+
+    # Workers write the slices of a run into a shared buffer at the slice's
+    # position in slice_list, so nothing has to be sent back and rearranged
+    # afterwards. Two buffers are used in turns - one is filled by the workers
+    # while the other one is written to the output file (with one buffer the
+    # runs are done one after the other).
+    rows = max(sum(run["slice_counts"]) for run in runs)
+    typecode = np.dtype(P["WorkingDtype"]).char
+    buffers = [multiprocessing.RawArray(typecode, rows * 4) for k in range(nbuffers)]
+    processes = P["SliceProcesses"] or multiprocessing.cpu_count()
+    slice_pool = multiprocessing.Pool(
+        processes,
+        initializer=InitSliceWorker,
+        initargs=(buffers, Beam["slice_args"], Beam["sampler"]),
+    )
+    momentum_pool = None
+    results = []
+    # Stage times - the stages shared by all runs are counted in the first run
+    times = dict(Beam["stage_times"])
+    checkpoints = {}
+
+    # Particles of run k in its buffer
+    def RunRows(k):
+        rows = sum(runs[k]["slice_counts"])
+        buffer = buffers[k % len(buffers)]
+        return np.ctypeslib.as_array(buffer)[: rows * 4].reshape(rows, 4)
+
+    # Start the slice tasks of run k - slices restored from its checkpoint (see
+    # RunCheckpoint) are copied into the buffer and not computed again
+    def SubmitSlices(k):
+        run = runs[k]
+        restored = None
+        if P["CheckpointInterval"] is not None or P["Resume"]:
+            checkpoints[k] = RunCheckpoint(
+                run["out_file"],
+                CheckpointKey(Beam, run, P),
+                P["WorkingDtype"],
+                P["CheckpointInterval"],
+                P["Resume"],
+            )
+            restored = checkpoints[k].restore(RunRows(k), run["slice_counts"])
+            if np.any(restored):
+                print("Slices restored from checkpoint:", np.count_nonzero(restored))
+        tasks = SliceTasks(
+            run, k % len(buffers), P["SliceChunkSize"], processes, restored
         )
-        return Full_PY
-
-    def Calculate_PZ():
-        Full_PZ = interpolate.griddata(
-            (mA_X.ravel(), mA_Y.ravel(), mA_Z.ravel()),
-            mA_PZ.ravel(),
-            (Full_X, Full_Y, Full_Z),
-            method="linear",
-            rescale=True,
+        return slice_pool.imap_unordered(SliceRangeWorker, tasks), restored
+
+    try:
+        # One triangulation of the input particles (or the windows of the
+        # windowed engine) is shared by all three momentum components and all runs
+        windows = None
+        if P["MomentumEngine"] == "windowed":
+            windows = (P["MomentumWindowOverlap"], P["MomentumWindowPoints"])
+        momentum_pool = StartMomentumPool(
+            Beam["mA_XYZ"],
+            Beam["mA_PXPYPZ"],
+            P["MomentumProcesses"],
+            max_rows=rows,
+            chunk_rows=P["MomentumChunkSize"],
+            triangulation=Beam["triangulation"],
+            windows=windows,
         )
-        return Full_PZ
-
-    # Parallel momentum data mapping
-    from multiprocessing.pool import ThreadPool
-
-    pool = ThreadPool(processes=3)
-    async_result_PX = pool.apply_async(Calculate_PX, ())
-    async_result_PY = pool.apply_async(Calculate_PY, ())
-    async_result_PZ = pool.apply_async(Calculate_PZ, ())
-    Full_PX = async_result_PX.get()
-    Full_PY = async_result_PY.get()
-    Full_PZ = async_result_PZ.get()
-
-    # Scale units from SI to p = p/mc
-
-    Full_PX = Full_PX / (m * c)
-    Full_PY = Full_PY / (m * c)
-    Full_PZ = Full_PZ / (m * c)
-
-    # Merge all data into one array
-    x_px_y_py_z_pz_NE = np.vstack(
-        [
-            Full_X.flat,
-            Full_PX.flat,
-            Full_Y.flat,
-            Full_PY.flat,
-            Full_Z.flat,
-            Full_PZ.flat,
-            Full_Ne.flat,
-        ]
-    ).T
-
-    # Add Poisson noise to particle weights
-    x_px_y_py_z_pz_NE[:, 6] = np.random.poisson(x_px_y_py_z_pz_NE[:, 6])
-
-    # Remove all particles with weights <= zero
-    x_px_y_py_z_pz_NE = x_px_y_py_z_pz_NE[x_px_y_py_z_pz_NE[:, 6] > 0]
-
-    # Check for NaN calues in data - it sometimes happen when using 'linear' option in momentum interpolations (griddata parameter)
-    NaN_Mask = ~np.any(np.isnan(x_px_y_py_z_pz_NE), axis=1)
-    x_px_y_py_z_pz_NE = x_px_y_py_z_pz_NE[NaN_Mask]
-
-    # Rescale the charge of new particle set (needed due to S_factor usage)
-    ChargeFactor = InitialParticleCharge / np.sum(x_px_y_py_z_pz_NE[:, 6] * e_ch)
-    print "Charge scaling factor = ", ChargeFactor
-    x_px_y_py_z_pz_NE[:, 6] = x_px_y_py_z_pz_NE[:, 6] * ChargeFactor
-
-    print "Final charge of particles = ", np.sum(x_px_y_py_z_pz_NE[:, 6] * e_ch)
-    print "Saving the output to files..."
-
-    # Create Group in HDF5 and add metadata for Visit
-    # Open output file
-    output_file = tables.open_file(out_file, "w")
-    ParticleGroup = output_file.create_array("/", "Particles", x_px_y_py_z_pz_NE)
-    boundsGroup = output_file.create_group("/", "globalGridGlobalLimits", "")
-    boundsGroup._v_attrs.vsType = "limits"
-    boundsGroup._v_attrs.vsKind = "Cartesian"
-    timeGroup = output_file.create_group("/", "time", "time")
-    timeGroup._v_attrs.vsType = "time"
-    ParticleGroup._v_attrs.vsType = "variableWithMesh"
-    ParticleGroup._v_attrs.vsTimeGroup = "time"
-    ParticleGroup._v_attrs.vsNumSpatialDims = 3
-    ParticleGroup._v_attrs.vsLimits = "globalGridGlobalLimits"
-    ParticleGroup._v_attrs.vsLabels = "x,px,y,py,z,pz,NE"
-    now = datetime.datetime.now()
-    ParticleGroup._v_attrs.FXFELConversionTime = now.strftime("%Y-%m-%d %H:%M:%S")
-    ParticleGroup._v_attrs.FXFELSourceFileName = file_name_in
-    # Close the file
-    output_file.close()
-    end = time.time()
-    print "Time of work: ", end - start
+        pending, restored = SubmitSlices(0)
+        submitted = time.time()
+        for k, run in enumerate(runs):
+            # Sweep over all slices along Z-axis (longitudinal direction) and generate new microparticles
+            # Routine is parallel and uses ALL available cores
+            print("Executing main JDF loop...")
+            print("Slices per wavelnegth = ", run["SlicesMultiplyFactor"])
+            progress = Progress("Slice", len(run["slice_list"]), P["ProgressInterval"])
+            checkpoint = checkpoints.get(k)
+            # Slices and particles computed by the workers
+            counts = np.asarray(run["slice_counts"], dtype=int)
+            if restored is not None:
+                progress.update(np.count_nonzero(restored))
+                counts = counts[~restored]
+            computed = len(counts)
+            computed_rows = int(np.sum(counts))
+            busy = 0.0
+            for first, last, done, task_time in TimedIter(pending, times, "slice loop"):
+                progress.update(done)
+                busy += task_time
+                if checkpoint is not None:
+                    checkpoint.slices_done(RunRows(k), first, last)
+            if checkpoint is not None:
+                checkpoint.save_slices(RunRows(k))
+            slice_time = time.time() - submitted
+            if k + 1 < len(runs) and len(buffers) > 1:
+                pending, restored = SubmitSlices(k + 1)
+                submitted = time.time()
+
+            # ==============================================================================
+            # ## SERIAL VERSION DEBUG ONLY !!!
+            #    InitSliceWorker(buffers, Beam["slice_args"], Beam["sampler"])
+            #    for task in SliceTasks(run, k % len(buffers)):
+            #        SliceRangeWorker(task)
+            # ==============================================================================
+
+            result = WriteRun(
+                Beam,
+                run,
+                buffers[k % len(buffers)],
+                momentum_pool,
+                P,
+                times,
+                checkpoint,
+            )
+            if checkpoint is not None:
+                checkpoint.close(remove=True)
+            if k + 1 < len(runs) and len(buffers) == 1:
+                pending, restored = SubmitSlices(k + 1)
+                submitted = time.time()
+            end = time.time()
+            print("Time of work: ", end - start)
+            result["Time_of_work"] = end - start
+            # Slice loop throughput and utilization of the slice worker pool
+            # (time the workers were busy / processes x time from submission
+            # of the tasks until the last slice was done)
+            result["slice_loop"] = {
+                "slices": computed,
+                "time": slice_time,
+                "slices_per_second": computed / max(slice_time, 1e-9),
+                "particles_per_second": computed_rows / max(slice_time, 1e-9),
+                "processes": processes,
+                "busy_time": busy,
+                "pool_utilization": busy / max(processes * slice_time, 1e-9),
+            }
+            if memory_plan is not None:
+                result["memory_plan"] = memory_plan
+            results.append(result)
+            start = end
+            times = {}
+    finally:
+        slice_pool.terminate()
+        slice_pool.join()
+        StopMomentumPool(momentum_pool)
+        for checkpoint in checkpoints.values():
+            checkpoint.close()
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+            print("Profile statistics saved to", profile_file)
+
+    # Reports are written once the worker processes are joined, so their peak
+    # memory is included
+    print("Peak memory [MB]: ", PeakRSS())
+    if P["RunReport"]:
+        for result in results:
+            print("Run report saved to", WriteRunReport(result, P))
+    return results
+
+
+# Main routine for JDF - upsamples the particles of file_name_in and writes them
+# to out_file (default: input name + "_JDF_" + seed + ".h5"). Parameters come from
+# params_module and params (see ReadParameters), plot_file saves the current
+# profile plot, nice lowers the process priority (os.nice) - this allows your
+# system to behave more smoothly while JDF still utilizes all of its resources.
+# profile_file saves cProfile statistics, shard=(index, count) computes one shard
+# of the run (see run_jdf_sweep). Returns a dict with a summary of the run.
+def run_jdf(
+    file_name_in,
+    params=None,
+    params_module="PARAMS_JDF",
+    out_file=None,
+    plot_file=None,
+    nice=None,
+    profile_file=None,
+    shard=None,
+):
+    run = {}
+    if out_file is not None:
+        run["out_file"] = out_file
+    return run_jdf_sweep(
+        file_name_in,
+        [run],
+        params,
+        params_module,
+        plot_file,
+        nice,
+        profile_file,
+        shard,
+    )[0]
+
+
+# Command line interface - values given on the command line override the ones
+# from the parameters file
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="JDF_NLIST",
+        description="Up- or down-sample particle data with the JDF method.",
+    )
+    parser.add_argument(
+        "file_name_in",
+        help="input HDF5 file with /Particles, .npy file or raw float64 file (.bin)",
+    )
+    parser.add_argument("-o", "--out-file", help="output file name")
+    parser.add_argument(
+        "-p",
+        "--params",
+        default="PARAMS_JDF",
+        help="parameters module name or .py file (default: PARAMS_JDF)",
+    )
+    parser.add_argument("-s", "--seed", type=int, help="RNG_seed")
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="set a parameter of the parameters file, e.g. NumOfSliceParticles=2000",
+    )
+    parser.add_argument(
+        "--plot", metavar="FILE", help="save current profile plot to FILE"
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="save cProfile statistics of the main process to FILE",
+    )
+    parser.add_argument(
+        "--shard",
+        metavar="INDEX/COUNT",
+        help="compute only shard INDEX (0 ... COUNT-1) of the run, e.g. the task "
+        "of a job array - combine the shard files with --merge COUNT",
+    )
+    parser.add_argument(
+        "--merge",
+        type=int,
+        metavar="COUNT",
+        help="merge the COUNT shard files of the run into its output file",
+    )
+    parser.add_argument(
+        "--keep-shards",
+        action="store_true",
+        help="do not delete the shard files after --merge / --mpi",
+    )
+    parser.add_argument(
+        "--mpi",
+        action="store_true",
+        help="one shard per MPI rank (needs mpi4py), rank 0 merges the shards",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=float,
+        metavar="MB",
+        help="choose worker processes and chunk sizes to stay below MB of memory",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=float,
+        metavar="SECONDS",
+        help="save the progress of the run every SECONDS to a checkpoint file",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue the run from its checkpoint file (needs the seed of the run)",
+    )
+    parser.add_argument(
+        "--downsample",
+        type=int,
+        metavar="N",
+        help="reduce the input to about N particles (conserves the charge, the "
+        "mean and rms of all coordinates) instead of upsampling it",
+    )
+    parser.add_argument(
+        "--seeds",
+        type=int,
+        nargs="+",
+        metavar="SEED",
+        help="one run per seed (the input beam is prepared once for all runs)",
+    )
+    parser.add_argument(
+        "--random-seeds",
+        type=int,
+        metavar="N",
+        help="N runs with random seeds",
+    )
+    parser.add_argument(
+        "--sweep",
+        action="append",
+        default=[],
+        metavar="NAME=V1,V2,...",
+        help="one run per value of NumOfSliceParticles or SlicesMultiplyFactor "
+        "(combined with every seed)",
+    )
+    parser.add_argument(
+        "--nice",
+        type=int,
+        nargs="?",
+        const=20,
+        help="lower the process priority by NICE (default when given: 20)",
+    )
+    args = parser.parse_args(argv)
+    if args.downsample is not None:
+        if args.downsample <= 0:
+            parser.error("--downsample N needs N > 0")
+        for option in ("seeds", "random_seeds", "sweep", "shard", "merge", "mpi"):
+            if getattr(args, option):
+                parser.error(
+                    "--%s can not be used with --downsample" % option.replace("_", "-")
+                )
+
+    import ast
+    import itertools
+
+    params = {}
+    for item in args.set:
+        name, sep, value = item.partition("=")
+        if not sep:
+            parser.error("--set expects NAME=VALUE, got " + item)
+        try:
+            params[name.strip()] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            params[name.strip()] = value
+    if args.seed is not None:
+        params["RNG_seed"] = args.seed
+    if args.max_memory is not None:
+        params["MaxMemory"] = args.max_memory
+    if args.checkpoint is not None:
+        params["CheckpointInterval"] = args.checkpoint
+    if args.resume:
+        params["Resume"] = True
+    for name in params:
+        if name not in JDF_PARAMETERS:
+            parser.error("unknown parameter " + name)
+
+    # Sweep - all combinations of the seeds and the swept values
+    sweep = []
+    if args.seeds:
+        sweep.append([("RNG_seed", seed) for seed in args.seeds])
+    elif args.random_seeds:
+        # Drawn once, so that every swept value is run with the same seeds
+        seeds = np.random.randint(0, 2**32, args.random_seeds, dtype=np.int64)
+        sweep.append([("RNG_seed", int(seed)) for seed in seeds])
+    for item in args.sweep:
+        name, sep, values = item.partition("=")
+        name = name.strip()
+        if not sep or name not in ("NumOfSliceParticles", "SlicesMultiplyFactor"):
+            parser.error("--sweep expects NumOfSliceParticles or SlicesMultiplyFactor")
+        try:
+            values = [ast.literal_eval(value) for value in values.split(",")]
+        except (ValueError, SyntaxError):
+            parser.error("invalid values in --sweep " + item)
+        sweep.append([(name, value) for value in values])
+    runs = [dict(run) for run in itertools.product(*sweep)]
+    if len(runs) > 1 and args.out_file:
+        parser.error("--out-file can not be used with more than one run")
+    if args.out_file:
+        runs[0]["out_file"] = args.out_file
+
+    if args.downsample is not None:
+        P = ReadParameters(params, args.params)
+        run = SweepRuns(args.file_name_in, P, runs[:1])[0]
+        result = DownsampleParticles(
+            args.file_name_in,
+            run["out_file"],
+            args.downsample,
+            seed=run["RNG_seed"],
+            chunk_rows=P["InputChunkSize"] or 1000000,
+            complevel=P["OutputCompression"],
+            reader=P["InputReader"],
+        )
+        if P["RunReport"]:
+            print("Run report saved to", WriteRunReport(result, P))
+        return 0
+
+    # Sharded runs - one shard of a job array, all shards with MPI, or merging
+    shard = None
+    comm = None
+    if args.shard:
+        index, sep, count = args.shard.partition("/")
+        try:
+            shard = (int(index), int(count))
+        except ValueError:
+            parser.error("--shard expects INDEX/COUNT, got " + args.shard)
+        if not 0 <= shard[0] < shard[1]:
+            parser.error("--shard INDEX must be between 0 and COUNT-1")
+    elif args.mpi:
+        try:
+            index, count, comm = MPIShard()
+        except ImportError:
+            parser.error("--mpi needs mpi4py")
+        shard = (index, count)
+    P = ReadParameters(params, args.params)
+    if args.random_seeds and (shard is not None or args.merge):
+        # Every process would draw other seeds
+        parser.error(
+            "sharded runs need fixed seeds (-s or --seeds), not --random-seeds"
+        )
+    if shard is not None or args.merge or P["Resume"]:
+        for run in runs:
+            if run.get("RNG_seed", P["RNG_seed"]) is None:
+                parser.error(
+                    "sharded and resumed runs need a seed (-s, --seeds or RNG_seed)"
+                )
+    if args.merge:
+        for run in SweepRuns(args.file_name_in, P, runs):
+            MergeShards(
+                run["out_file"],
+                args.merge,
+                P["OutputCompression"],
+                remove=not args.keep_shards,
+            )
+        return 0
+
+    results = run_jdf_sweep(
+        args.file_name_in,
+        runs,
+        params=params,
+        params_module=args.params,
+        plot_file=args.plot,
+        nice=args.nice,
+        profile_file=args.profile,
+        shard=shard,
+    )
+    if comm is not None:
+        comm.Barrier()
+        if comm.Get_rank() == 0:
+            for result in results:
+                MergeShards(
+                    result["merged_file"],
+                    shard[1],
+                    P["OutputCompression"],
+                    remove=not args.keep_shards,
+                )
+        comm.Barrier()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
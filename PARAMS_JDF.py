@@ -6,5 +6,33 @@ Y_DensitySampling = 40
 Z_DensitySampling = 80
 BeamStretchFactor = 0.0
 NumOfSliceParticles = 800
+# DensityInterpolation = "linear" # "nearest" (default) or "linear" (trilinear)
+# DensityEstimator = "kde" # linear binning and FFT Gaussian kernel density estimate (default "histogram" - histogram smoothed by one bin)
+# DensityBandwidth = (2e-6, 2e-6, 1e-7) # kde: bandwidth in m, one value or per axis X, Y, Z (default None - Scott's rule)
+# DensityCrop = 1e-4 # cut the density grid in X and Y to all but this fraction of the charge on either side
+# InputChunkSize = 1000000 # input rows read at once, default: whole file (the density histograms, and so the output, change at round-off level)
+# MomentumSampleSize = 5000000 # max. input particles used for momentum interpolation
+# OutputCompression = 1 # zlib level of the output file (0-9, 0 = uncompressed)
+# SliceProcesses = 4 # processes for the slice loop, default: all cores
+# SliceChunkSize = 16 # slices per task, default: about 4 tasks per process
+# MomentumProcesses = 4 # processes for momentum interpolation, default: all cores
+# MomentumChunkSize = 100000 # new particles per momentum interpolation task
 # RNG_seed = 123456789 # Must be an integer between 0 and 2**32-1 (inclusive)
 # out_file="upsampled.h5" # default: input_name + "_JDF_" + str(seed) + ".h5"
+# ProgressInterval = 10.0 # seconds between progress messages of the slice loop
+# RunReport = False # no JSON report (output name + "_report.json") of the run
+# CacheDir = "~/.cache/jdf" # cache of beam models for repeated runs on the same input
+# CacheSize = 2000 # max. size of the cache in MB, least recently used files are removed
+# WorkingDtype = "float32" # new particles and momentum input in float32 - saves memory, runs with |z| beyond about 1e4 slice lengths are refused
+# AdaptiveSliceParticles = True # particles per slice follow the current, NumOfSliceParticles at the peak
+# SliceParticlesMin = 50 # min. particles per slice with AdaptiveSliceParticles
+# ParticleBudget = 2000000 # max. total number of new particles with AdaptiveSliceParticles
+# MomentumEngine = "windowed" # momentum interpolation in z windows (default "delaunay" - one triangulation of all input particles)
+# MomentumWindowOverlap = 0.1 # windowed: windows are extended by 0.1 of their length on both sides
+# MomentumWindowPoints = 10000 # windowed: input particles per window
+# InputReader = "h5py" # reader of the input file: "tables", "h5py", "npy" or "raw" (default: by the file name)
+# SamplingMode = "joint" # sample all particles at once from the 3D density map (default "slices" - slice by slice)
+# JointSliceZ = True # joint: place the particles on the slice structure in z
+# MaxMemory = 8000 # memory budget in MB - worker processes and chunk sizes are chosen to stay below it
+# CheckpointInterval = 600 # save the progress of a run to <out>_checkpoint.h5 every 600 s
+# Resume = True # continue runs from their checkpoints (same as --resume)
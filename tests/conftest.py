@@ -0,0 +1,72 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import JDF_BENCHMARK  # noqa: E402
+import JDF_NLIST  # noqa: E402
+
+# Small runs on the synthetic beam - about 30 slices of 100 particles
+PARAMS = {
+    "k_u": 228.48,
+    "a_u": 2.12,
+    "SlicesMultiplyFactor": 0.01,
+    "X_DensitySampling": 20,
+    "Y_DensitySampling": 20,
+    "Z_DensitySampling": 40,
+    "NumOfSliceParticles": 100,
+    "RNG_seed": 1234,
+    "RunReport": False,
+    "SliceProcesses": 2,
+    "MomentumProcesses": 2,
+}
+
+
+@pytest.fixture(scope="session")
+def beam_file(tmp_path_factory):
+    file_name = str(tmp_path_factory.mktemp("beam") / "beam.h5")
+    JDF_BENCHMARK.SyntheticBeam(file_name, 4000, seed=1)
+    return file_name
+
+
+# Run JDF_NLIST on beam_file (or file_name_in) with PARAMS updated by params, writing to name in
+# the test directory - returns the output file name
+@pytest.fixture
+def run_file(beam_file, tmp_path):
+    def RunFile(name, params=None, file_name_in=None, **kwargs):
+        out_file = str(tmp_path / name)
+        JDF_NLIST.run_jdf(
+            file_name_in or beam_file,
+            params=dict(PARAMS, **(params or {})),
+            params_module=None,
+            out_file=out_file,
+            **kwargs
+        )
+        return out_file
+
+    return RunFile
+
+
+# As run_file, returns the rows of the output file
+@pytest.fixture
+def run_rows(run_file):
+    def RunRows(name, params=None, file_name_in=None, **kwargs):
+        return ReadRows(run_file(name, params, file_name_in, **kwargs))
+
+    return RunRows
+
+
+# Rows of an output file
+@pytest.fixture
+def read_rows():
+    return ReadRows
+
+
+def ReadRows(file_name):
+    f = JDF_NLIST.ParticleFile(file_name)
+    rows = np.array(f.Particles[:])
+    f.close()
+    return rows
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+import JDF_NLIST
+from conftest import ReadRows
+
+
+# Beam with one far halo particle in +x (5e-5 of the charge) - the core falls
+# into the first bin of the density grid in x
+@pytest.fixture(scope="module")
+def halo_file(beam_file, tmp_path_factory):
+    rows = ReadRows(beam_file)
+    halo = rows[:1].copy()
+    halo[0, 0] = 1000.0 * np.std(rows[:, 0])
+    halo[0, 6] = 5e-5 * np.sum(rows[:, 6])
+    file_name = str(tmp_path_factory.mktemp("halo") / "halo.npy")
+    np.save(file_name, np.vstack((rows, halo)))
+    return file_name
+
+
+# Cropped grids keep at least two nodes in every axis
+def test_crop_keeps_two_nodes(halo_file):
+    f = JDF_NLIST.ParticleFile(halo_file)
+    stats = JDF_NLIST.ScanParticles(f.Particles)
+    nodes = [np.linspace(stats["min"][c], stats["max"][c], 20) for c in (0, 2)]
+    new_x, new_y = JDF_NLIST.CropNodes(f.Particles, (0, 2), nodes, 1e-4)
+    f.close()
+    assert len(new_x) >= 2
+    assert len(new_y) >= 2
+
+
+# KDE density map on a cropped grid - all new particles are kept, with the
+# charge of the input
+@pytest.mark.parametrize("estimator", ["histogram", "kde"])
+def test_cropped_density_run(halo_file, run_rows, estimator):
+    params = {"DensityEstimator": estimator, "DensityCrop": 1e-4}
+    rows = run_rows("a.h5", params, file_name_in=halo_file)
+    assert len(rows) > 0
+    assert np.all(np.isfinite(rows))
+    f = JDF_NLIST.ParticleFile(halo_file)
+    charge = np.sum(f.Particles[:, 6])
+    f.close()
+    assert np.isclose(np.sum(rows[:, 6]), charge, rtol=1e-9)
+
+
+# The FFT convolution of KernelDensity is a Gaussian filter of the grid, with
+# zero outside of it
+def test_kernel_density_matches_gaussian_filter():
+    from scipy import ndimage
+
+    grid = np.random.RandomState(0).random_sample((30, 25, 40))
+    sigma = [1.5, 0.0, 2.0]
+    reference = ndimage.gaussian_filter(grid, sigma, mode="constant", truncate=8.0)
+    result = JDF_NLIST.KernelDensity(grid.copy(), sigma)
+    assert np.allclose(result, reference, rtol=0.0, atol=1e-4 * np.max(reference))
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+import JDF_NLIST
+
+
+# Shards of a run merged into one file - the same particles as the run itself
+def test_merged_shards_match_single_run(run_file, run_rows, read_rows):
+    reference = run_rows("a.h5")
+    for index in range(3):
+        out_file = run_file("b.h5", shard=(index, 3))
+    JDF_NLIST.MergeShards(out_file, 3, remove=True)
+    assert np.array_equal(read_rows(out_file), reference)
+
+
+# A run interrupted in the slice loop or in the momentum mapping and resumed
+# from its checkpoint - the same output as an uninterrupted run
+@pytest.mark.parametrize("stage", ["slices_done", "momentum_done"])
+@pytest.mark.parametrize("out_file", ["b.h5", "b.npy"])
+def test_resumed_run_matches_uninterrupted(run_rows, monkeypatch, stage, out_file):
+    params = {"SliceChunkSize": 3, "MomentumChunkSize": 500}
+    reference = run_rows("a.h5", params)
+    params["CheckpointInterval"] = 0.0
+    calls = []
+    done = getattr(JDF_NLIST.RunCheckpoint, stage)
+
+    def Interrupt(self, *args, **kwargs):
+        done(self, *args, **kwargs)
+        calls.append(1)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(JDF_NLIST.RunCheckpoint, stage, Interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        run_rows(out_file, params)
+    monkeypatch.setattr(JDF_NLIST.RunCheckpoint, stage, done)
+    params["Resume"] = True
+    assert np.array_equal(run_rows(out_file, params), reference)
+
+
+# The beam cache is kept apart for every WorkingDtype - a float64 run after a
+# float32 one gives the same output as without the cache
+def test_cache_keeps_working_dtypes_apart(run_rows, tmp_path):
+    reference = run_rows("a.h5")
+    cache = {"CacheDir": str(tmp_path / "cache")}
+    run_rows("b.h5", dict(cache, WorkingDtype="float32"))
+    assert np.array_equal(run_rows("c.h5", cache), reference)
+    # Loaded from the cache
+    assert np.array_equal(run_rows("d.h5", cache), reference)
+
+
+# --random-seeds draws the seeds once, every swept value runs with all of them
+def test_random_seeds_shared_by_sweep(beam_file, monkeypatch):
+    sweeps = []
+    monkeypatch.setattr(
+        JDF_NLIST, "run_jdf_sweep", lambda file_name_in, runs, **kw: sweeps.append(runs)
+    )
+    JDF_NLIST.main(
+        [
+            beam_file,
+            "--params",
+            "no_params",
+            "--random-seeds",
+            "2",
+            "--sweep",
+            "NumOfSliceParticles=50,80",
+        ]
+    )
+    runs = sweeps[0]
+    assert len(runs) == 4
+    seeds = set(run["RNG_seed"] for run in runs)
+    assert len(seeds) == 2 and None not in seeds
+    for value in (50, 80):
+        assert (
+            set(run["RNG_seed"] for run in runs if run["NumOfSliceParticles"] == value)
+            == seeds
+        )
+
+
+# Random seeds are drawn by every process - shards would not fit together
+@pytest.mark.parametrize("option", [["--shard", "0/2"], ["--merge", "2"]])
+def test_random_seeds_rejected_for_shards(beam_file, option):
+    with pytest.raises(SystemExit):
+        JDF_NLIST.main(
+            [beam_file, "--params", "no_params", "--random-seeds", "2"] + option
+        )
+
+
+# A resumed run finds its checkpoint by the seed
+def test_random_seeds_rejected_for_resume(beam_file):
+    with pytest.raises(SystemExit):
+        JDF_NLIST.main(
+            [beam_file, "--params", "no_params", "--random-seeds", "2", "--resume"]
+        )
@@ -0,0 +1,48 @@
+import numpy as np
+
+import JDF_NLIST
+
+
+# JDF_CORE_BATCH draws all particles of a slice at once - the same numbers as
+# JDF_CORE called for every particle
+def test_batch_slice_sampler_matches_scalar():
+    rng = np.random.RandomState(0)
+    X_inp = np.linspace(-1.0, 1.0, 12)
+    Y_inp = np.linspace(-2.0, 2.0, 10)
+    dist_in = rng.random_sample((10, 12))
+    halton = JDF_NLIST.HaltonRandomNumber(2, 200)
+    batch = JDF_NLIST.JDF_CORE_BATCH(
+        X_inp, Y_inp, dist_in, 1.0, halton[:, 0], halton[:, 1], 0.5, 3.0
+    )
+    for k in range(len(halton)):
+        scalar = JDF_NLIST.JDF_CORE(
+            None, X_inp, Y_inp, dist_in, 1.0, halton[k, 0], halton[k, 1], 0.5, 3.0
+        )
+        assert np.array_equal(batch[k], scalar.ravel())
+
+
+# The slices are computed into shared buffers by the worker processes - the
+# output does not depend on the number of processes or on how the slices are
+# split into tasks
+def test_output_independent_of_slice_workers(run_rows):
+    reference = run_rows("a.h5", {"SliceProcesses": 1})
+    assert len(reference) > 0
+    for params in ({"SliceProcesses": 3}, {"SliceChunkSize": 1}):
+        assert np.array_equal(run_rows("b.h5", params), reference)
+
+
+# Chunked reading of the input - the scan is independent of the chunk size,
+# the output differs at round-off level only (density histogram sums)
+def test_chunked_reading(beam_file, run_rows):
+    f = JDF_NLIST.ParticleFile(beam_file)
+    whole = JDF_NLIST.ScanParticles(f.Particles)
+    chunked = JDF_NLIST.ScanParticles(f.Particles, 333)
+    f.close()
+    for name in ("n", "total_weight", "gamma_0"):
+        assert whole[name] == chunked[name]
+    assert np.array_equal(whole["min"], chunked["min"])
+    assert np.array_equal(whole["max"], chunked["max"])
+    reference = run_rows("a.h5")
+    rows = run_rows("b.h5", {"InputChunkSize": 333})
+    assert rows.shape == reference.shape
+    assert np.allclose(rows, reference, rtol=1e-9, atol=0.0)